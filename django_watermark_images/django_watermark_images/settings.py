@@ -44,6 +44,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'items.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -146,4 +147,137 @@ CACHES = {
 
 WATERMARK_IMAGE = os.path.join(BASE_DIR, 'assets/img/Coat_of_arms_of_Ireland.png')
 
+WATERMARK_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Layout of the tiled watermarks: the size of each watermark relative to the shorter side of the image, the space
+# between them relative to their size, their rotation (in degrees) and their opacity (0-255).
+WATERMARK_TILE = {'tile_size': 0.2, 'spacing': 0.5, 'angle': 30, 'opacity': 25}
+
+# Fonts are loaded once per process, by name: 'default' is used by the text overlay view and 'text-overlay' by the
+# items:text-overlay generator. The rendered text is cached in TEXT_SPRITE_CACHE_MAX_BYTES.
+FONTS = {
+    'default': ('/usr/share/fonts/dejavu/DejaVuSans-Bold.ttf', 24),
+    'text-overlay': ('/usr/share/fonts/dejavu/DejaVuSans-Bold.ttf', 36),
+}
+
+TEXT_SPRITE_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+RENDITION_WORKERS = 2
+
+# Besides the full size renditions, a variant scaled down to each of RENDITION_WIDTHS narrower than the image is
+# generated. They are listed in the srcset of the <img> tags, so that browsers download the one they need.
+RENDITION_WIDTHS = (320, 640, 1280)
+
+# Renditions are known to exist from the RenditionFile index, kept in the database and, up to
+# RENDITION_INDEX_MAX_BYTES of names, in memory, so that rendering them doesn't require any storage call.
+IMAGEKIT_DEFAULT_CACHEFILE_BACKEND = 'items.cachefiles.IndexedCacheFileBackend'
+
+RENDITION_INDEX_MAX_BYTES = 1024 * 1024
+
+# Used by the regenerate_renditions command and the batch endpoint. None means one worker process per CPU.
+RENDITIONS_BATCH_WORKERS = None
+
+RENDITIONS_BATCH_CHECKPOINT = os.path.join(BASE_DIR, 'renditions_batch.checkpoint')
+
+# Used by the scan_payloads command. None means one worker process per CPU.
+PAYLOAD_SCAN_WORKERS = None
+
+# Images with at least this many pixels are processed one region (or horizontal strip) at a time, keeping the
+# temporary buffers of each step under TILED_PROCESSING_MAX_BYTES.
+TILED_PROCESSING_MIN_PIXELS = 16 * 1024 * 1024
+
+TILED_PROCESSING_MAX_BYTES = 32 * 1024 * 1024
+
+# Image operations requested through the forms run 'inline' (in the request thread), in a 'thread' pool or in a
+# 'process' pool. When IMAGE_EXECUTOR_WORKERS + IMAGE_EXECUTOR_QUEUE_DEPTH operations are pending, new requests are
+# answered with 503 Service Unavailable. Operations that haven't started IMAGE_EXECUTOR_TIMEOUT seconds after being
+# submitted are cancelled and reported as failed, and are submitted again by the next request for the same result.
+# Operations that started are left to finish.
+IMAGE_EXECUTOR = 'thread'
+
+IMAGE_EXECUTOR_WORKERS = 2
+
+IMAGE_EXECUTOR_QUEUE_DEPTH = 8
+
+IMAGE_EXECUTOR_TIMEOUT = 60
+
+IMAGE_EXECUTOR_RETRY_AFTER = 10
+
+# Uploaded images with more than IMAGE_MAX_PIXELS pixels are rejected from their header, before being decoded. The
+# ones with a side longer than IMAGE_MAX_WORKING_SIZE are decoded at a reduced scale (in draft mode for JPEG) and
+# downscaled before being processed. Source images are stored as they were uploaded.
+IMAGE_MAX_PIXELS = 64 * 1024 * 1024
+
+IMAGE_MAX_WORKING_SIZE = 4096
+
+# The frames of animated (and multi-page) images are processed on FRAME_WORKERS threads, and the results are
+# animated GIFs that keep the duration of every frame.
+FRAME_WORKERS = 4
+
+# Uploads larger than FILE_UPLOAD_MAX_MEMORY_SIZE bytes are spooled to a temporary file in FILE_UPLOAD_TEMP_DIR (the
+# system's temporary directory if None) instead of being kept in memory.
+FILE_UPLOAD_MAX_MEMORY_SIZE = 1024 * 1024
+
+FILE_UPLOAD_TEMP_DIR = None
+
+# Output format and save options of each operation, used both by the form views and by the imagekit generators.
+# Profiles with 'webp' options also store a WebP version of the results, which is served to browsers that accept it.
+# The steganography profile must be lossless, or the hidden text would be lost.
+ENCODING_PROFILES = {
+    'text-overlay': {
+        'format': 'JPEG',
+        'options': {'quality': 75, 'optimize': True, 'progressive': True},
+        'webp': {'quality': 75, 'method': 4},
+    },
+    'watermark': {
+        'format': 'JPEG',
+        'options': {'quality': 75, 'optimize': True, 'progressive': True},
+        'webp': {'quality': 75, 'method': 4},
+    },
+    'steganography': {
+        'format': 'PNG',
+        'options': {'compress_level': 1},
+    },
+    'robust-steganography': {
+        'format': 'JPEG',
+        'options': {'quality': 75, 'optimize': True, 'progressive': True},
+    },
+}
+
+# Source and result images of the form views. Expired images are deleted every SWEEP_INTERVAL seconds by a
+# background thread, or by the sweep_results command. items.stores.MemoryResultStore keeps them in memory instead.
+RESULT_STORE = {
+    'BACKEND': 'items.stores.FileSystemResultStore',
+    'OPTIONS': {
+        'location': os.path.join(BASE_DIR, 'results'),
+    },
+    'TTL': 24 * 60 * 60,
+    'SWEEP_INTERVAL': 60 * 60,
+}
+
+# URL prefix of an internal nginx location aliased to the location of the FileSystemResultStore. When set, the
+# cached images are sent by nginx (X-Accel-Redirect) once the view has checked them, so slow downloads don't hold
+# a worker.
+RESULT_STORE_ACCEL_REDIRECT_URL = None
+
+# Times the stages of the image pipeline (upload parsing, decoding, processing, encoding, storing...) into histograms
+# exposed in Prometheus' text format at /metrics/. METRICS_SERVER_TIMING also adds them to a Server-Timing header.
+# The histograms are kept in memory by each process of the web server, and /metrics/ only exports those of the process
+# that answers it (the jobs of a process pool are counted by the process that submitted them).
+METRICS_ENABLED = False
+
+METRICS_SERVER_TIMING = False
+
+METRICS_SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# The benchmark_images command fails when comparing with a previous run if the median time of a case grew more than
+# this fraction, and more than BENCHMARK_REGRESSION_MIN_SECONDS (so that very short cases don't fail on noise).
+BENCHMARK_REGRESSION_THRESHOLD = 0.1
+
+BENCHMARK_REGRESSION_MIN_SECONDS = 0.005
+
 PLACEHOLDER_IMAGE = os.path.join(BASE_DIR, 'assets/img/missing_image.png')
+
+# Hidden watermarks written by older versions store a pickle in the LSBs. Unpickling data taken from an uploaded
+# image is unsafe, so only enable this when all the images are trusted.
+STEGANOGRAPHY_LEGACY_PICKLE = False
@@ -21,7 +21,8 @@ from django.contrib import admin
 from django.views.generic.base import RedirectView
 
 from items.views import (text_overlay, watermark, steganography, text_overlay_result, watermark_result,
-                         steganography_result, cached_image, item_detail, item_create)
+                         steganography_result, scan, cached_image, result_status, result_stats, metrics,
+                         renditions_batch, item_detail, item_create)
 
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
@@ -32,8 +33,13 @@ urlpatterns = [
     url(r'^watermark-result/(?P<result_id>[0-9a-f]{32})/$', watermark_result, name='watermark-result'),
     url(r'^steganography/$', steganography, name='steganography'),
     url(r'^steganography-result/(?P<result_id>[0-9a-f]{32})/$', steganography_result, name='steganography-result'),
+    url(r'^scan/$', scan, name='scan'),
     url(r'^cached-image/(?P<key>.+)/$', cached_image, name='cached-image'),
+    url(r'^result-status/(?P<result_id>[0-9a-f]{32})/$', result_status, name='result-status'),
+    url(r'^result-stats/$', result_stats, name='result-stats'),
+    url(r'^metrics/$', metrics, name='metrics'),
     url(r'^items/$', item_create, name='item-create'),
+    url(r'^items/renditions/batch/$', renditions_batch, name='renditions-batch'),
     url(r'^items/(?P<pk>\d+)/$', item_detail, name='item-detail')
 ]
 
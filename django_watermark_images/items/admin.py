@@ -1,10 +1,26 @@
 from django.contrib import admin
 
-from .models import Item
+from .models import Item, ItemPayload, RenditionFile
 
 
 class ItemAdmin(admin.ModelAdmin):
-    list_display = ('id', 'title', 'created', 'modified', 'image')
+    list_display = ('id', 'title', 'created', 'modified', 'image', 'renditions_status')
 
 
 admin.site.register(Item, ItemAdmin)
+
+
+class ItemPayloadAdmin(admin.ModelAdmin):
+    list_display = ('id', 'item', 'generator_id', 'engine', 'payload', 'name')
+    search_fields = ('payload',)
+
+
+admin.site.register(ItemPayload, ItemPayloadAdmin)
+
+
+class RenditionFileAdmin(admin.ModelAdmin):
+    list_display = ('id', 'name', 'width', 'height')
+    search_fields = ('name',)
+
+
+admin.site.register(RenditionFile, RenditionFileAdmin)
@@ -3,3 +3,10 @@ from django.apps import AppConfig
 
 class ItemsConfig(AppConfig):
     name = 'items'
+
+    def ready(self):
+        from . import signals  # noqa
+        from .encoding import get_encoding_profile
+
+        # Fails on start up if the hidden watermarks would be saved with a lossy format
+        get_encoding_profile('steganography', lossless=True)
@@ -0,0 +1,286 @@
+import json
+import math
+import platform
+import resource
+import statistics
+import sys
+import time
+import tracemalloc
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+import django
+import numpy as np
+import PIL
+
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import Client
+from django.test.utils import override_settings, setup_test_environment
+from django.urls import reverse
+
+from PIL import Image
+
+from .processors import (add_text_overlay, add_tiled_watermark, add_watermark, dct_decode, dct_encode, lsb_decode,
+                         lsb_encode)
+
+
+MODES = ('RGB', 'RGBA', 'P', 'L', 'CMYK')
+
+MEGAPIXELS = (0.3, 2, 12, 50)
+
+_benchmark_text = 'django-watermark-images'
+
+
+def create_image(megapixels, mode, seed=0):
+    """Creates a deterministic 3:2 image with gradients and noise, so that it neither compresses too well nor too
+    badly."""
+    width = int(round(math.sqrt(megapixels * 1000000 * 3 / 2)))
+    height = int(round(width * 2 / 3))
+    random_state = np.random.RandomState(seed)
+
+    array = np.empty((height, width, 3), dtype=np.uint8)
+    array[..., 0] = np.linspace(0, 223, width, dtype=np.uint8)[np.newaxis, :]
+    array[..., 1] = np.linspace(0, 223, height, dtype=np.uint8)[:, np.newaxis]
+    array[..., 2] = 128
+
+    for band in range(3):
+        array[..., band] += random_state.randint(0, 32, (height, width)).astype(np.uint8)
+
+    image = Image.fromarray(array, 'RGB')
+
+    if mode == 'RGBA':
+        image.putalpha(Image.fromarray(array[..., 1], 'L'))
+    elif mode == 'P':
+        image = image.convert('P', palette=Image.ADAPTIVE)
+    elif mode != 'RGB':
+        image = image.convert(mode)
+
+    return image
+
+
+def _setup_text_overlay(image):
+    return lambda: add_text_overlay(image, _benchmark_text)
+
+
+def _setup_watermark(image):
+    watermark = Image.open(settings.WATERMARK_IMAGE)
+    watermark.load()
+    return lambda: add_watermark(image, watermark, watermark_key=settings.WATERMARK_IMAGE)
+
+
+def _setup_tiled_watermark(image):
+    watermark = Image.open(settings.WATERMARK_IMAGE)
+    watermark.load()
+    return lambda: add_tiled_watermark(image, watermark, watermark_key=settings.WATERMARK_IMAGE,
+                                       **settings.WATERMARK_TILE)
+
+
+def _setup_lsb_encode(image):
+    return lambda: lsb_encode(_benchmark_text, image)
+
+
+def _setup_lsb_decode(image):
+    encoded_image = lsb_encode(_benchmark_text, image)
+    return lambda: lsb_decode(encoded_image)
+
+
+def _setup_dct_encode(image):
+    return lambda: dct_encode(_benchmark_text, image)
+
+
+def _setup_dct_decode(image):
+    encoded_image = dct_encode(_benchmark_text, image)
+    return lambda: dct_decode(encoded_image)
+
+
+PROCESSORS = OrderedDict((
+    ('text-overlay', _setup_text_overlay),
+    ('watermark', _setup_watermark),
+    ('tiled-watermark', _setup_tiled_watermark),
+    ('lsb-encode', _setup_lsb_encode),
+    ('lsb-decode', _setup_lsb_decode),
+    ('dct-encode', _setup_dct_encode),
+    ('dct-decode', _setup_dct_decode),
+))
+
+
+def _get_upload(image):
+    format_ = 'PNG' if image.mode in ('RGBA', 'P') else 'JPEG'
+    bytes_io = BytesIO()
+    image.save(bytes_io, format=format_)
+    return 'image.{extension}'.format(extension=format_.lower()), bytes_io.getvalue(), Image.MIME[format_]
+
+
+def _setup_view(url_name, image, **data):
+    """Posts the form of the view, follows the redirect to the result page and downloads the result image. Uploads
+    are given as (name, content, content_type) tuples."""
+    data['image'] = _get_upload(image)
+    client = Client()
+    runs = [0]
+
+    setup_test_environment()
+
+    def request():
+        runs[0] += 1
+        post_data = {name: SimpleUploadedFile(*value) if isinstance(value, tuple) else value
+                     for name, value in data.items()}
+
+        # Every run gets an empty cache and result store, so that the result is always created
+        with override_settings(IMAGE_EXECUTOR='inline',
+                               CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                                   'LOCATION': 'benchmark-{run}'.format(run=runs[0])}},
+                               RESULT_STORE={'BACKEND': 'items.stores.MemoryResultStore'}):
+            response = client.post(reverse(url_name), post_data)
+
+            if response.status_code != 302:
+                raise RuntimeError('{url_name} answered with {status_code}'.format(url_name=url_name,
+                                                                                  status_code=response.status_code))
+
+            client.get(response['Location'])
+            result_id = response['Location'].rstrip('/').rsplit('/', 1)[-1]
+            result_status = json.loads(client.get(reverse('result-status', kwargs={'result_id': result_id}))
+                                       .content.decode('utf-8'))
+
+            if result_status['status'] != 'done':
+                raise RuntimeError('{url_name} failed: {error}'.format(url_name=url_name, error=result_status['error']))
+
+            image_response = client.get(reverse('cached-image', kwargs={'key': 'result-image-' + result_id}))
+            return b''.join(image_response.streaming_content)
+
+    return request
+
+
+def _setup_text_overlay_view(image):
+    return _setup_view('text-overlay', image, text=_benchmark_text)
+
+
+def _setup_watermark_view(image):
+    with open(settings.WATERMARK_IMAGE, 'rb') as fp:
+        watermark_image = ('watermark.png', fp.read(), 'image/png')
+
+    return _setup_view('watermark', image, watermark_image=watermark_image, layout='center')
+
+
+def _setup_tiled_watermark_view(image):
+    with open(settings.WATERMARK_IMAGE, 'rb') as fp:
+        watermark_image = ('watermark.png', fp.read(), 'image/png')
+
+    return _setup_view('watermark', image, watermark_image=watermark_image, layout='tiled')
+
+
+def _setup_steganography_view(image):
+    return _setup_view('steganography', image, text=_benchmark_text, engine='lsb')
+
+
+def _setup_robust_steganography_view(image):
+    return _setup_view('steganography', image, text=_benchmark_text, engine='dct')
+
+
+VIEWS = OrderedDict((
+    ('text-overlay', _setup_text_overlay_view),
+    ('watermark', _setup_watermark_view),
+    ('tiled-watermark', _setup_tiled_watermark_view),
+    ('steganography', _setup_steganography_view),
+    ('robust-steganography', _setup_robust_steganography_view),
+))
+
+
+def _get_max_rss():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def _run_case(kind, name, megapixels, mode, repeat):
+    image = create_image(megapixels, mode)
+    fn = (PROCESSORS if kind == 'processor' else VIEWS)[name](image)
+    max_rss = _get_max_rss()
+
+    # The first run also fills the caches (fonts, text sprites, prepared watermarks), so it is reported on its own
+    start = time.perf_counter()
+    fn()
+    first_time = time.perf_counter() - start
+
+    times = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    peak_rss = _get_max_rss()
+
+    # Allocations are traced on a separate run, since tracing slows everything down
+    tracemalloc.start()
+    fn()
+    allocated, allocated_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'id': '{kind}:{name}:{mode}:{megapixels}mp'.format(kind=kind, name=name, mode=mode, megapixels=megapixels),
+        'kind': kind,
+        'name': name,
+        'mode': mode,
+        'megapixels': megapixels,
+        'size': image.size,
+        'repeat': repeat,
+        'first_time': first_time,
+        'min_time': min(times),
+        'median_time': statistics.median(times),
+        'peak_rss': peak_rss,
+        'peak_rss_increase': peak_rss - max_rss,
+        'allocated_peak': allocated_peak,
+    }
+
+
+def run_benchmarks(processors=None, views=None, megapixels=MEGAPIXELS, modes=MODES, repeat=5, progress=None):
+    """Runs every case in a new process, so that the peak RSS of one doesn't hide the one of the next."""
+    cases = [('processor', name) for name in (PROCESSORS if processors is None else processors)]
+    cases += [('view', name) for name in (VIEWS if views is None else views)]
+    results = []
+
+    for kind, name in cases:
+        for case_megapixels in megapixels:
+            for mode in modes:
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    result = executor.submit(_run_case, kind, name, case_megapixels, mode, repeat).result()
+
+                results.append(result)
+
+                if progress is not None:
+                    progress(result)
+
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'pillow': PIL.__version__,
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+        },
+        'results': results,
+    }
+
+
+def compare_benchmarks(baseline, current, threshold, min_delta=0):
+    """Returns the cases whose median time grew more than threshold (a fraction) and more than min_delta seconds over
+    the baseline. The latter keeps the noise of very short cases from being reported."""
+    baseline_results = {result['id']: result for result in baseline['results']}
+    regressions = []
+
+    for result in current['results']:
+        baseline_result = baseline_results.get(result['id'])
+
+        if baseline_result is None:
+            continue
+
+        change = result['median_time'] / baseline_result['median_time'] - 1
+
+        if change > threshold and result['median_time'] - baseline_result['median_time'] > min_delta:
+            regressions.append((result['id'], baseline_result['median_time'], result['median_time'], change))
+
+    return regressions
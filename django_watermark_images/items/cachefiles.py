@@ -0,0 +1,57 @@
+from django.conf import settings
+from django.db import IntegrityError
+from imagekit.cachefiles.backends import CacheFileState, Simple
+
+from .lru import LRUCache
+from .models import RenditionFile
+
+
+_rendition_files = LRUCache(settings.RENDITION_INDEX_MAX_BYTES)
+
+
+def get_rendition_dimensions(name):
+    """Returns the dimensions of an indexed cache file, or None if it isn't known to exist. Only the cache files found
+    in the index are kept in memory, so that a file generated by another process is looked up again."""
+    dimensions = _rendition_files.get(name)
+
+    if dimensions is None:
+        dimensions = RenditionFile.objects.filter(name=name).values_list('width', 'height').first()
+
+        if dimensions is not None:
+            _rendition_files.set(name, dimensions, len(name))
+
+    return dimensions
+
+
+def index_rendition(name, width, height):
+    try:
+        RenditionFile.objects.update_or_create(name=name, defaults={'width': width, 'height': height})
+    except IntegrityError:
+        # Indexed by another process in the meantime
+        pass
+
+    _rendition_files.set(name, (width, height), len(name))
+
+
+def unindex_rendition(name):
+    RenditionFile.objects.filter(name=name).delete()
+    _rendition_files.delete(name)
+
+
+class IndexedCacheFileBackend(Simple):
+    """Cache file backend that knows which cache files exist from the rendition index, and only asks the storage about
+    the ones that aren't indexed yet."""
+
+    def get_state(self, file, check_if_unknown=True):
+        if get_rendition_dimensions(file.name) is not None:
+            return CacheFileState.EXISTS
+
+        return super().get_state(file, check_if_unknown=check_if_unknown)
+
+    def set_state(self, file, state):
+        super().set_state(file, state)
+
+        if state == CacheFileState.EXISTS:
+            # Right after the file is generated its dimensions are read from the generated content, otherwise the
+            # file is read once from the storage
+            index_rendition(file.name, file.width, file.height)
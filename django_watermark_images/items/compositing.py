@@ -0,0 +1,62 @@
+from django.conf import settings
+from PIL import Image
+
+
+_alpha_modes = ('RGBA', 'RGBa', 'LA', 'La', 'PA')
+
+
+def _use_tiled_processing(image):
+    return image.size[0] * image.size[1] >= settings.TILED_PROCESSING_MIN_PIXELS
+
+
+def _get_strips(box, max_pixels):
+    left, top, right, bottom = box
+    strip_height = max(max_pixels // max(right - left, 1), 1)
+
+    for strip_top in range(top, bottom, strip_height):
+        yield left, strip_top, right, min(strip_top + strip_height, bottom)
+
+
+def _has_transparent_palette(image):
+    return 'transparency' in image.info or getattr(image.palette, 'mode', 'RGB') == 'RGBA'
+
+
+def get_composite_image(image):
+    """Returns a copy of the image that patches can be composited onto: RGBA if the image has transparency, RGB
+    otherwise."""
+    if image.mode in ('RGB', 'RGBA'):
+        return image.copy()
+
+    if image.mode in _alpha_modes or (image.mode == 'P' and _has_transparent_palette(image)):
+        return image.convert('RGBA')
+
+    return image.convert('RGB')
+
+
+def composite_patch(image, patch, xy):
+    """Composites an RGBA patch onto an RGB or RGBA image (see get_composite_image) at xy, in place. Only the part of
+    the image under the patch is copied, so the memory used is proportional to the patch, not to the image."""
+    image_x, image_y = image.size
+    left, top = xy
+    box = (max(left, 0), max(top, 0), min(left + patch.size[0], image_x), min(top + patch.size[1], image_y))
+
+    if box[0] >= box[2] or box[1] >= box[3]:
+        return
+
+    if image.mode == 'RGB':
+        # Over an opaque image, alpha_composite reduces to the rounded division by 255 of a paste through the alpha
+        # of the patch, which Pillow does in place
+        patch = patch.crop((box[0] - left, box[1] - top, box[2] - left, box[3] - top))
+        image.paste(patch, box[:2], patch)
+        return
+
+    if _use_tiled_processing(image):
+        # Each strip needs a crop of the image, a crop of the patch and the composite, 4 bytes per pixel each
+        max_pixels = settings.TILED_PROCESSING_MAX_BYTES // 12
+    else:
+        max_pixels = (box[2] - box[0]) * (box[3] - box[1])
+
+    for strip_box in _get_strips(box, max_pixels):
+        strip_left, strip_top, strip_right, strip_bottom = strip_box
+        patch_strip = patch.crop((strip_left - left, strip_top - top, strip_right - left, strip_bottom - top))
+        image.paste(Image.alpha_composite(image.crop(strip_box), patch_strip), (strip_left, strip_top))
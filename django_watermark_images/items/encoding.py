@@ -0,0 +1,94 @@
+import hashlib
+import json
+
+from io import BytesIO
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from PIL import Image
+from pilkit.utils import save_image
+
+from .compositing import get_composite_image
+from .metrics import get_stage_totals, span
+
+
+_lossless_formats = ('PNG', 'BMP', 'TIFF')
+
+
+def _is_lossless(format_, options):
+    return format_.upper() in _lossless_formats or (format_.upper() == 'WEBP' and options.get('lossless', False))
+
+
+def _webp_supported():
+    Image.init()
+    return 'WEBP' in Image.SAVE
+
+
+def get_encoding_profile(name, lossless=False):
+    try:
+        profile = settings.ENCODING_PROFILES[name]
+    except KeyError:
+        raise ImproperlyConfigured('Unknown encoding profile {name!r}'.format(name=name))
+
+    if lossless and not _is_lossless(profile['format'], profile.get('options', {})):
+        raise ImproperlyConfigured('Encoding profile {name!r} must use a lossless format'.format(name=name))
+
+    if lossless and 'webp' in profile and not _is_lossless('WEBP', profile['webp']):
+        raise ImproperlyConfigured('Encoding profile {name!r} must use lossless WebP'.format(name=name))
+
+    return profile
+
+
+def get_encoding_profile_key(name):
+    """Identifies the profile along with its format and options, so that results encoded before it changed are not
+    reused."""
+    profile_hash = hashlib.sha1(json.dumps(get_encoding_profile(name), sort_keys=True).encode('utf-8'))
+    return '{name}:{hash}'.format(name=name, hash=profile_hash.hexdigest()[:16])
+
+
+def has_webp_variant(name):
+    return 'webp' in get_encoding_profile(name) and _webp_supported()
+
+
+def _get_encode_stage(name, format_):
+    return 'encode-{name}-{format}'.format(name=name, format=format_.lower())
+
+
+def encode_image(image, name, lossless=False, webp=False):
+    profile = get_encoding_profile(name, lossless=lossless)
+
+    if webp:
+        format_, options = 'WEBP', profile['webp']
+
+        # WebP only stores RGB and RGBA images
+        if image.mode not in ('RGB', 'RGBA'):
+            image = get_composite_image(image)
+    else:
+        format_, options = profile['format'], profile.get('options', {})
+
+    with span(_get_encode_stage(name, format_), size=image.size) as encode_span:
+        image_bytes = save_image(image, BytesIO(), format_, options=options).getvalue()
+        encode_span.bytes = len(image_bytes)
+
+    return image_bytes, Image.MIME.get(format_.upper(), 'application/octet-stream')
+
+
+def get_encoding_stats():
+    """Returns the number of images, average size and average encoding time of every profile, from the encode spans
+    of the metrics (of the current process)."""
+    encoding_stats = {}
+    stage_totals = get_stage_totals()
+
+    for name, profile in settings.ENCODING_PROFILES.items():
+        for format_ in (profile['format'], 'WEBP') if 'webp' in profile else (profile['format'],):
+            stats = stage_totals.get(_get_encode_stage(name, format_))
+
+            if stats is not None and stats['count']:
+                encoding_stats['{name}:{format}'.format(name=name, format=format_.lower())] = {
+                    'count': stats['count'],
+                    'average_bytes': stats['bytes'] / stats['count'],
+                    'average_seconds': stats['seconds'] / stats['count']
+                }
+
+    return encoding_stats
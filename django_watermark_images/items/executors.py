@@ -0,0 +1,111 @@
+import os
+import threading
+
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connections
+from django.dispatch import receiver
+from django.core.exceptions import ImproperlyConfigured
+
+
+class ExecutorBusy(Exception):
+    pass
+
+
+class InlineExecutor(object):
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+
+        return future
+
+
+class BoundedExecutor(object):
+    def __init__(self, executor, max_pending):
+        self._executor = executor
+        self._semaphore = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, fn, *args, **kwargs):
+        if not self._semaphore.acquire(blocking=False):
+            raise ExecutorBusy()
+
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self._semaphore.release()
+            raise
+
+        future.add_done_callback(lambda f: self._semaphore.release())
+        return future
+
+
+def warm_up():
+    from . import processors
+    processors.WatermarkProcessor.watermark.load()
+
+    for font_name in settings.FONTS:
+        processors.get_font(font_name)
+
+
+def _create_executor():
+    backend = settings.IMAGE_EXECUTOR
+    workers = settings.IMAGE_EXECUTOR_WORKERS
+
+    if backend == 'inline':
+        return InlineExecutor()
+    elif backend == 'thread':
+        executor = ThreadPoolExecutor(max_workers=workers)
+    elif backend == 'process':
+        executor = create_process_pool(workers)
+
+        for _ in range(workers):
+            executor.submit(warm_up)
+    else:
+        raise ImproperlyConfigured('Unknown IMAGE_EXECUTOR {backend!r}'.format(backend=backend))
+
+    return BoundedExecutor(executor, workers + settings.IMAGE_EXECUTOR_QUEUE_DEPTH)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+
+    # Created on first use, so that pre-forking servers don't share a pool between workers
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = _create_executor()
+
+    return _executor
+
+
+def is_inline():
+    return isinstance(get_executor(), InlineExecutor)
+
+
+def get_worker_count(workers=None):
+    return workers or os.cpu_count() or 1
+
+
+def create_process_pool(workers):
+    """Creates a pool of worker processes. The connections are closed before the workers are forked, so that they
+    don't inherit an open database connection (the current process opens a new one when it needs it)."""
+    connections.close_all()
+    return ProcessPoolExecutor(max_workers=workers)
+
+
+@receiver(setting_changed)
+def _reset_executor(setting, **kwargs):
+    global _executor
+
+    if setting.startswith('IMAGE_EXECUTOR'):
+        _executor = None
@@ -1,11 +1,46 @@
 from django import forms
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.utils.translation import ugettext_lazy as _
 
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Layout, Submit
+from PIL import Image
 
 from .models import Item
 
 
+class LimitedImageField(forms.ImageField):
+    default_error_messages = {
+        'too_large': _('The image is too large (%(width)sx%(height)s pixels). Images can have at most '
+                       '%(max_pixels)s pixels.'),
+    }
+
+    def to_python(self, data):
+        # Unlike forms.ImageField, the image is only opened, which parses its header, and not verified. It's kept open
+        # on the upload, so that it can be decoded without parsing the header again.
+        f = super(forms.ImageField, self).to_python(data)
+
+        if f is None:
+            return None
+
+        try:
+            image = Image.open(f)
+        except Exception:
+            raise ValidationError(self.error_messages['invalid_image'], code='invalid_image')
+
+        width, height = image.size
+
+        if width * height > settings.IMAGE_MAX_PIXELS:
+            raise ValidationError(self.error_messages['too_large'], code='too_large',
+                                  params={'width': width, 'height': height,
+                                          'max_pixels': settings.IMAGE_MAX_PIXELS})
+
+        f.image = image
+        f.content_type = Image.MIME.get(image.format, 'application/octet-stream')
+        return f
+
+
 class TextOverlayForm(forms.Form):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -21,7 +56,7 @@ class TextOverlayForm(forms.Form):
         )
 
     text = forms.CharField(label='Text', max_length=100, required=True)
-    image = forms.ImageField(label='Source Image', required=True)
+    image = LimitedImageField(label='Source Image', required=True)
 
 
 class WatermarkForm(forms.Form):
@@ -35,11 +70,18 @@ class WatermarkForm(forms.Form):
         self.helper.layout = Layout(
             'image',
             'watermark_image',
+            'layout',
             Submit('submit', 'Submit', css_class='btn-default pull-right')
         )
 
-    image = forms.ImageField(label='Source Image', required=True)
-    watermark_image = forms.ImageField(label='Watermark Image', required=True)
+    LAYOUT_CHOICES = (
+        ('center', _('Centered')),
+        ('tiled', _('Tiled')),
+    )
+
+    image = LimitedImageField(label='Source Image', required=True)
+    watermark_image = LimitedImageField(label='Watermark Image', required=True)
+    layout = forms.ChoiceField(label='Layout', choices=LAYOUT_CHOICES, initial='center', required=True)
 
 
 class SteganographyForm(forms.Form):
@@ -53,17 +95,41 @@ class SteganographyForm(forms.Form):
         self.helper.layout = Layout(
             'text',
             'image',
+            'engine',
             Submit('submit', 'Submit', css_class='btn-default pull-right')
         )
 
+    ENGINE_CHOICES = (
+        ('lsb', _('Least significant bits (lossless images only)')),
+        ('dct', _('DCT (survives JPEG recompression)')),
+    )
+
     text = forms.CharField(label='Text', max_length=500, widget=forms.Textarea, required=True)
-    image = forms.ImageField(label='Source Image', required=True)
+    image = LimitedImageField(label='Source Image', required=True)
+    engine = forms.ChoiceField(label='Engine', choices=ENGINE_CHOICES, initial='lsb', required=True)
+
+
+class ScanForm(forms.Form):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.helper = FormHelper()
+        self.helper.form_id = 'scan-form'
+        self.helper.form_class = 'form-horizontal'
+        self.helper.label_class = 'col-lg-2'
+        self.helper.field_class = 'col-lg-10'
+        self.helper.layout = Layout(
+            'image',
+            Submit('submit', 'Scan', css_class='btn-default pull-right')
+        )
+
+    image = LimitedImageField(label='Image', required=True)
 
 
 class ItemForm(forms.ModelForm):
     class Meta:
         model = Item
         fields = ('title', 'description', 'image')
+        field_classes = {'image': LimitedImageField}
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -0,0 +1,192 @@
+import struct
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from PIL import Image, ImageSequence
+
+from .metrics import span
+
+
+_default_frame_duration = 100
+
+_gif_trailer = b';'
+_gif_extension = 0x21
+_gif_application_extension = 0xFF
+_gif_graphic_control_extension = 0xF9
+_gif_image_descriptor = 0x2C
+_gif_color_table_flag = 0x80
+_gif_disposal_mask = 0x1C
+# Every frame covers the whole image, so each one is cleared before the next is drawn, otherwise the transparent
+# pixels of a frame would show the previous one
+_gif_restore_background = 2 << 2
+
+# Maps the alpha of a frame to the mask of its transparent pixels, the ones that are mostly transparent
+_gif_transparency_table = [255] * 128 + [0] * 128
+
+
+def is_multi_frame(image):
+    return getattr(image, 'n_frames', 1) > 1
+
+
+def iter_frames(image):
+    """Yields a copy of each frame of the image along with its duration (in milliseconds), seeking one frame at a
+    time, so that only the frame being copied is decoded."""
+    for frame in ImageSequence.Iterator(image):
+        yield frame.copy(), frame.info.get('duration') or _default_frame_duration
+
+
+def _get_gif_frame(image):
+    """Converts a processed frame back to a palette, with a transparent color for the pixels that are mostly
+    transparent."""
+    if image.mode != 'RGBA':
+        return image.convert('RGB').convert('P', palette=Image.ADAPTIVE), None
+
+    frame = image.convert('RGB').convert('P', palette=Image.ADAPTIVE, colors=255)
+    frame.paste(255, mask=image.split()[3].point(_gif_transparency_table, '1'))
+    return frame, 255
+
+
+def encode_gif_frame(image, duration, loop=None):
+    frame, transparency = _get_gif_frame(image)
+    options = {'duration': duration}
+
+    if transparency is not None:
+        options['transparency'] = transparency
+
+    if loop is not None:
+        options['loop'] = loop
+
+    bytes_io = BytesIO()
+    frame.save(bytes_io, format='GIF', **options)
+    return bytes_io.getvalue()
+
+
+def _get_color_table_size(flags):
+    return 3 << ((flags & 0x07) + 1) if flags & _gif_color_table_flag else 0
+
+
+def _skip_sub_blocks(data, offset):
+    while data[offset]:
+        offset += data[offset] + 1
+
+    return offset + 1
+
+
+def _split_gif(data):
+    """Splits a GIF into its header (signature and logical screen descriptor), its global color table and its
+    blocks (extensions and images)."""
+    color_table_end = 13 + _get_color_table_size(data[10])
+    blocks = []
+    offset = color_table_end
+
+    while data[offset] != _gif_trailer[0]:
+        if data[offset] == _gif_extension:
+            end = _skip_sub_blocks(data, offset + 2)
+        elif data[offset] == _gif_image_descriptor:
+            # The image descriptor and its color table are followed by the LZW code size and the image data
+            end = _skip_sub_blocks(data, offset + 10 + _get_color_table_size(data[offset + 9]) + 1)
+        else:
+            raise ValueError('Unexpected GIF block 0x{block:02x}'.format(block=data[offset]))
+
+        blocks.append(data[offset:end])
+        offset = end
+
+    return data[:13], data[13:color_table_end], blocks
+
+
+def _get_screen_size(header):
+    return struct.unpack('<HH', header[6:10])
+
+
+def _place_blocks(blocks, offset):
+    """Moves the image of a single frame GIF by offset and sets its disposal method, adding a graphic control
+    extension if the frame has none."""
+    has_graphic_control = False
+
+    for block in blocks:
+        if block[0] == _gif_extension and block[1] == _gif_graphic_control_extension:
+            has_graphic_control = True
+            flags = (block[3] & ~_gif_disposal_mask) | _gif_restore_background
+            block = block[:3] + struct.pack('B', flags) + block[4:]
+        elif block[0] == _gif_image_descriptor:
+            if not has_graphic_control:
+                yield struct.pack('<BBBBHBB', _gif_extension, _gif_graphic_control_extension, 4,
+                                  _gif_restore_background, 0, 0, 0)
+
+            left, top = struct.unpack('<HH', block[1:5])
+            block = block[:1] + struct.pack('<HH', left + offset[0], top + offset[1]) + block[5:]
+
+        yield block
+
+
+def _get_local_blocks(blocks, color_table, screen_flags):
+    """Moves the global color table of a single frame GIF to its image, so that the frame can be appended to another
+    GIF. The application extensions (the loop count) are left to the first frame."""
+    for block in blocks:
+        if block[0] == _gif_extension and block[1] == _gif_application_extension:
+            continue
+
+        if block[0] == _gif_image_descriptor and color_table and not block[9] & _gif_color_table_flag:
+            image_flags = block[9] | _gif_color_table_flag | (screen_flags & 0x07)
+            block = block[:9] + struct.pack('B', image_flags) + color_table + block[10:]
+
+        yield block
+
+
+def join_gif_frames(frames, fp):
+    """Writes the single frame GIFs (as returned by encode_gif_frame) to fp as one animated GIF. Every frame keeps its
+    own palette and duration. The image is as large as the largest frame, and smaller frames (pages of different
+    sizes) are centered on it."""
+    split_frames = [_split_gif(frame_bytes) for frame_bytes in frames]
+    frame_sizes = [_get_screen_size(header) for header, color_table, blocks in split_frames]
+    screen_x, screen_y = max(size[0] for size in frame_sizes), max(size[1] for size in frame_sizes)
+
+    for index, (header, color_table, blocks) in enumerate(split_frames):
+        frame_x, frame_y = frame_sizes[index]
+        blocks = _place_blocks(blocks, ((screen_x - frame_x) // 2, (screen_y - frame_y) // 2))
+
+        if index == 0:
+            fp.write(header[:6] + struct.pack('<HH', screen_x, screen_y) + header[10:])
+            fp.write(color_table)
+            fp.writelines(blocks)
+        else:
+            fp.writelines(_get_local_blocks(blocks, color_table, header[10]))
+
+    fp.write(_gif_trailer)
+
+
+def _process_frame(fn, frame, duration, loop=None):
+    with span('frame', size=frame.size):
+        return encode_gif_frame(fn(frame), duration, loop=loop)
+
+
+def process_frames(image, fn, workers=None):
+    """Applies fn to every frame of a multi-frame image and returns the result as an animated GIF.
+
+    The first frame is processed on its own, so that what fn prepares for it (text sprites, scaled watermarks) is
+    cached before the other frames are processed on a pool of threads. Frames are read and encoded as they go, and at
+    most two per thread are held decoded at once.
+    """
+    workers = workers or settings.FRAME_WORKERS
+    frames = iter_frames(image)
+    frame, duration = next(frames)
+    frame_bytes = [_process_frame(fn, frame, duration, loop=image.info.get('loop', 0))]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+
+        for frame, duration in frames:
+            pending.append(executor.submit(_process_frame, fn, frame, duration))
+
+            while len(pending) >= 2 * workers:
+                frame_bytes.append(pending.popleft().result())
+
+        while pending:
+            frame_bytes.append(pending.popleft().result())
+
+    bytes_io = BytesIO()
+    join_gif_frames(frame_bytes, bytes_io)
+    return bytes_io.getvalue()
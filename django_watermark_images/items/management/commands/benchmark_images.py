@@ -0,0 +1,72 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from items.benchmarks import MEGAPIXELS, MODES, PROCESSORS, VIEWS, compare_benchmarks, run_benchmarks
+
+
+class Command(BaseCommand):
+    help = ('Measures the wall time, peak RSS and Python allocations of the image processors and of the form views, '
+            'on synthetic images of several sizes and modes.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processor', action='append', dest='processors', choices=list(PROCESSORS),
+                            help='Processor to measure (defaults to all of them).')
+        parser.add_argument('--view', action='append', dest='views', choices=list(VIEWS),
+                            help='Form view to measure end to end (defaults to all of them).')
+        parser.add_argument('--no-processors', action='store_true', default=False,
+                            help="Don't measure the processors.")
+        parser.add_argument('--no-views', action='store_true', default=False, help="Don't measure the views.")
+        parser.add_argument('--megapixels', action='append', type=float,
+                            help='Size of the images, in megapixels (defaults to {megapixels}).'.format(
+                                megapixels=', '.join(str(megapixels) for megapixels in MEGAPIXELS)))
+        parser.add_argument('--mode', action='append', dest='modes', choices=MODES,
+                            help='Mode of the images (defaults to all of them).')
+        parser.add_argument('--repeat', type=int, default=5, help='Number of timed runs of each case.')
+        parser.add_argument('--output', help='JSON file where the results are written.')
+        parser.add_argument('--compare', help='JSON file of a previous run to compare the results with.')
+        parser.add_argument('--threshold', type=float, default=settings.BENCHMARK_REGRESSION_THRESHOLD,
+                            help='Fails when the median time of a case grows more than this fraction.')
+        parser.add_argument('--min-delta', type=float, default=settings.BENCHMARK_REGRESSION_MIN_SECONDS,
+                            help='Ignores the cases whose median time grows less than this many seconds.')
+
+    def handle(self, *args, **options):
+        baseline = None
+
+        if options['compare']:
+            with open(options['compare']) as fp:
+                baseline = json.load(fp)
+
+        def progress(result):
+            self.stdout.write(
+                '{id}: {median_time:.4f}s median, {min_time:.4f}s min, {first_time:.4f}s first, '
+                '{peak_rss_increase_mb:.1f} MB peak RSS increase, {allocated_peak_mb:.1f} MB allocated'.format(
+                    peak_rss_increase_mb=result['peak_rss_increase'] / 1024 / 1024,
+                    allocated_peak_mb=result['allocated_peak'] / 1024 / 1024, **result
+                )
+            )
+
+        benchmarks = run_benchmarks(processors=[] if options['no_processors'] else options['processors'],
+                                    views=[] if options['no_views'] else options['views'],
+                                    megapixels=options['megapixels'] or MEGAPIXELS,
+                                    modes=options['modes'] or MODES, repeat=options['repeat'], progress=progress)
+
+        if options['output']:
+            with open(options['output'], 'w') as fp:
+                json.dump(benchmarks, fp, indent=2)
+
+        if baseline is not None:
+            regressions = compare_benchmarks(baseline, benchmarks, options['threshold'], options['min_delta'])
+
+            if regressions:
+                raise CommandError('{count} cases regressed more than {threshold:.0%}:\n{regressions}'.format(
+                    count=len(regressions), threshold=options['threshold'], regressions='\n'.join(
+                        '{id}: {baseline:.4f}s -> {current:.4f}s ({change:+.0%})'.format(
+                            id=id_, baseline=baseline_time, current=current_time, change=change
+                        ) for id_, baseline_time, current_time, change in regressions
+                    )
+                ))
+
+            self.stdout.write(self.style.SUCCESS('No case regressed more than {threshold:.0%}'.format(
+                threshold=options['threshold'])))
@@ -0,0 +1,38 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from items.renditions import regenerate_renditions
+
+
+class Command(BaseCommand):
+    help = 'Regenerates the renditions of every Item that are missing or out of date.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.RENDITIONS_BATCH_WORKERS,
+                            help='Number of worker processes (defaults to the number of CPUs).')
+        parser.add_argument('--force', action='store_true', default=False,
+                            help='Regenerate the renditions even if they are up to date.')
+        parser.add_argument('--checkpoint', default=settings.RENDITIONS_BATCH_CHECKPOINT,
+                            help='File used to resume an interrupted run.')
+        parser.add_argument('--restart', action='store_true', default=False,
+                            help='Ignore the checkpoint of a previous run.')
+
+    def handle(self, *args, **options):
+        checkpoint_path = options['checkpoint']
+
+        if options['restart'] and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+        def progress(stats):
+            if options['verbosity'] > 1:
+                self.stdout.write('{processed} processed, {skipped} skipped, {failed} failed'.format(**stats))
+
+        stats = regenerate_renditions(workers=options['workers'], force=options['force'],
+                                      checkpoint_path=checkpoint_path, progress=progress)
+
+        self.stdout.write(self.style.SUCCESS(
+            '{processed} items processed, {skipped} skipped, {failed} failed in {seconds:.1f}s '
+            '({images_per_second:.2f} images/s, {megabytes_per_second:.2f} MB/s)'.format(**stats)
+        ))
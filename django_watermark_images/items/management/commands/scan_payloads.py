@@ -0,0 +1,56 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from items.payloads import find_items, get_payload_text, scan_paths
+
+
+class Command(BaseCommand):
+    help = ('Scans images for hidden watermarks and lists the Items that carry their payloads. Without paths, '
+            '--payload only looks the payload up in the index built when the renditions are generated.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*',
+                            help='Image files or directories to scan (defaults to MEDIA_ROOT unless --payload is '
+                                 'given).')
+        parser.add_argument('--payload', help='Only report this payload.')
+        parser.add_argument('--engine', action='append', dest='engines', choices=('lsb', 'dct'),
+                            help='Engine to look for (defaults to lsb, the dct engine decodes every image in full '
+                                 'and is much slower).')
+        parser.add_argument('--workers', type=int, default=settings.PAYLOAD_SCAN_WORKERS,
+                            help='Number of worker processes (defaults to the number of CPUs).')
+
+    def _write_items(self, payload):
+        items = find_items(payload)
+
+        for item in items:
+            self.stdout.write('  item {pk}: {title}'.format(pk=item.pk, title=item.title))
+
+        if not items:
+            self.stdout.write('  no indexed item')
+
+    def handle(self, *args, **options):
+        payload = options['payload']
+
+        if payload is not None and not options['paths']:
+            self.stdout.write(payload)
+            self._write_items(payload)
+            return
+
+        stats = {'scanned': 0, 'found': 0, 'failed': 0}
+
+        def progress(current_stats):
+            stats.update(current_stats)
+
+        for path, engine, found_payload in scan_paths(options['paths'] or [settings.MEDIA_ROOT],
+                                                      engines=options['engines'] or ('lsb',),
+                                                      workers=options['workers'], progress=progress):
+            if payload is not None and get_payload_text(found_payload) != payload:
+                continue
+
+            self.stdout.write('{path} ({engine}): {payload}'.format(path=path, engine=engine,
+                                                                    payload=get_payload_text(found_payload)))
+            self._write_items(found_payload)
+
+        self.stdout.write(self.style.SUCCESS(
+            '{scanned} images scanned, {found} with a payload, {failed} failed'.format(**stats)
+        ))
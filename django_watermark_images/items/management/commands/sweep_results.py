@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from items.stores import get_result_store
+
+
+class Command(BaseCommand):
+    help = 'Deletes the stored images that are older than the RESULT_STORE TTL.'
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.SUCCESS('{swept} files swept'.format(swept=get_result_store().sweep())))
@@ -0,0 +1,221 @@
+import threading
+import time
+
+from bisect import bisect_left
+
+from django.conf import settings
+
+
+_bytes_buckets = tuple(4 ** exponent * 1024 for exponent in range(2, 10))
+
+_megapixels_buckets = (0.5, 2, 8, 32)
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+_local = threading.local()
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _get_megapixels_label(size):
+    megapixels = size[0] * size[1] / 1000000
+    index = bisect_left(_megapixels_buckets, megapixels)
+    return str(_megapixels_buckets[index]) if index < len(_megapixels_buckets) else '+Inf'
+
+
+def _observe(name, labels, value, buckets):
+    key = (name, labels)
+
+    with _histograms_lock:
+        histogram = _histograms.get(key)
+
+        if histogram is None:
+            histogram = _histograms[key] = Histogram(buckets)
+
+        histogram.observe(value)
+
+
+def record(entries):
+    """Adds (stage, seconds, size, bytes) entries to the histograms, or to the entries being collected."""
+    collector = getattr(_local, 'collector', None)
+
+    if collector is not None:
+        collector.extend(entries)
+        return
+
+    for stage, seconds, size, bytes_ in entries:
+        labels = (('stage', stage),)
+
+        if size is not None:
+            labels += (('megapixels', _get_megapixels_label(size)),)
+
+        _observe('image_stage_seconds', labels, seconds, settings.METRICS_SECONDS_BUCKETS)
+
+        if bytes_ is not None:
+            _observe('image_stage_bytes', (('stage', stage),), bytes_, _bytes_buckets)
+
+
+def observe(stage, seconds, size=None, bytes=None):
+    if settings.METRICS_ENABLED:
+        record(((stage, seconds, size, bytes),))
+
+
+class Span(object):
+    """Times a stage of the image pipeline. The size of the image and the number of bytes can be given up front or
+    set on the span before it ends."""
+
+    def __init__(self, stage, size=None, bytes=None):
+        self.stage = stage
+        self.size = size
+        self.bytes = bytes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record(((self.stage, time.perf_counter() - self.start, self.size, self.bytes),))
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_null_span = _NullSpan()
+
+
+def span(stage, size=None, bytes=None):
+    if not settings.METRICS_ENABLED:
+        return _null_span
+
+    return Span(stage, size=size, bytes=bytes)
+
+
+class _Collector(object):
+    """Collects the entries of the spans that end in the current thread instead of adding them to the histograms, so
+    that they can be reported elsewhere (in a Server-Timing header, or by the process that submitted a job)."""
+
+    def __enter__(self):
+        self.previous = getattr(_local, 'collector', None)
+        _local.collector = []
+        return _local.collector
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _local.collector = self.previous
+
+
+def collect():
+    return _Collector()
+
+
+def get_stage_totals():
+    """Returns the number of spans and the total seconds and bytes of every stage, over all the image sizes."""
+    stage_totals = {}
+
+    with _histograms_lock:
+        for (name, labels), histogram in _histograms.items():
+            totals = stage_totals.setdefault(dict(labels)['stage'], {'count': 0, 'seconds': 0, 'bytes': 0})
+
+            if name == 'image_stage_seconds':
+                totals['count'] += histogram.count
+                totals['seconds'] += histogram.sum
+            else:
+                totals['bytes'] += histogram.sum
+
+    return stage_totals
+
+
+def _format_labels(labels):
+    return ','.join('{name}="{value}"'.format(name=name, value=value) for name, value in labels)
+
+
+def _format_bucket(bucket):
+    return '+Inf' if bucket is None else repr(float(bucket))
+
+
+def export_prometheus():
+    """Formats the histograms of the current process in Prometheus' text format."""
+    with _histograms_lock:
+        histograms = sorted((key, list(histogram.counts), histogram.sum, histogram.count, histogram.buckets)
+                            for key, histogram in _histograms.items())
+
+    lines = [
+        '# HELP image_stage_seconds Time spent in each stage of the image pipeline.',
+        '# TYPE image_stage_seconds histogram',
+    ]
+    bytes_lines = [
+        '# HELP image_stage_bytes Size of the images read or written by each stage of the image pipeline.',
+        '# TYPE image_stage_bytes histogram',
+    ]
+
+    for (name, labels), counts, sum_, count, buckets in histograms:
+        metric_lines = lines if name == 'image_stage_seconds' else bytes_lines
+        cumulative_count = 0
+
+        for bucket, bucket_count in zip(tuple(buckets) + (None,), counts):
+            cumulative_count += bucket_count
+            metric_lines.append('{name}_bucket{{{labels}}} {count}'.format(
+                name=name, labels=_format_labels(labels + (('le', _format_bucket(bucket)),)), count=cumulative_count
+            ))
+
+        metric_lines.append('{name}_sum{{{labels}}} {sum}'.format(name=name, labels=_format_labels(labels),
+                                                                   sum=repr(float(sum_))))
+        metric_lines.append('{name}_count{{{labels}}} {count}'.format(name=name, labels=_format_labels(labels),
+                                                                       count=count))
+
+    return '\n'.join(lines + bytes_lines) + '\n'
+
+
+def get_server_timing(entries):
+    durations = {}
+
+    for stage, seconds, size, bytes_ in entries:
+        durations[stage] = durations.get(stage, 0) + seconds
+
+    return ', '.join('{stage};dur={milliseconds:.1f}'.format(stage=stage, milliseconds=seconds * 1000)
+                     for stage, seconds in sorted(durations.items(), key=lambda item: item[1], reverse=True))
+
+
+class MetricsMiddleware(object):
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.METRICS_ENABLED:
+            return self.get_response(request)
+
+        with collect() as entries:
+            start = time.perf_counter()
+
+            if request.method == 'POST':
+                # Reading POST parses the whole request body, uploads included
+                with span('upload-parse', bytes=int(request.META.get('CONTENT_LENGTH') or 0)):
+                    request.POST
+
+            response = self.get_response(request)
+            entries.append(('request', time.perf_counter() - start, None, None))
+
+        if settings.METRICS_SERVER_TIMING:
+            response['Server-Timing'] = get_server_timing(entries)
+
+        record(entries)
+        return response
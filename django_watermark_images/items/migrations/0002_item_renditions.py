@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10 on 2026-10-18 10:22
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('items', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='renditions_generated',
+            field=models.PositiveSmallIntegerField(default=0, editable=False, verbose_name='renditions generated'),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='renditions_status',
+            field=models.CharField(choices=[('pending', 'pending'), ('queued', 'queued'), ('running', 'running'), ('done', 'done'), ('failed', 'failed')], default='pending', editable=False, max_length=16, verbose_name='renditions status'),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='renditions_total',
+            field=models.PositiveSmallIntegerField(default=0, editable=False, verbose_name='renditions total'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10 on 2026-10-18 10:30
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('items', '0002_item_renditions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='renditions_fingerprint',
+            field=models.CharField(blank=True, editable=False, max_length=40, verbose_name='renditions fingerprint'),
+        ),
+    ]
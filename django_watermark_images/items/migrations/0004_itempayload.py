@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10 on 2026-10-18 11:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('items', '0003_item_renditions_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ItemPayload',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('generator_id', models.CharField(max_length=100, verbose_name='generator id')),
+                ('engine', models.CharField(max_length=16, verbose_name='engine')),
+                ('payload', models.TextField(verbose_name='payload')),
+                ('payload_hash', models.CharField(db_index=True, max_length=64, verbose_name='payload hash')),
+                ('name', models.CharField(max_length=255, verbose_name='rendition name')),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='payloads', to='items.Item', verbose_name='item')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='itempayload',
+            unique_together=set([('item', 'generator_id')]),
+        ),
+    ]
@@ -12,10 +12,66 @@ def image_upload_to(instance, filename):
 
 
 class Item(TitleDescriptionModel, TimeStampedModel):
+    RENDITIONS_PENDING = 'pending'
+    RENDITIONS_QUEUED = 'queued'
+    RENDITIONS_RUNNING = 'running'
+    RENDITIONS_DONE = 'done'
+    RENDITIONS_FAILED = 'failed'
+    RENDITIONS_STATUS_CHOICES = (
+        (RENDITIONS_PENDING, _('pending')),
+        (RENDITIONS_QUEUED, _('queued')),
+        (RENDITIONS_RUNNING, _('running')),
+        (RENDITIONS_DONE, _('done')),
+        (RENDITIONS_FAILED, _('failed')),
+    )
+
     image = models.ImageField(_('original image'), upload_to=image_upload_to)
+    renditions_status = models.CharField(_('renditions status'), max_length=16, choices=RENDITIONS_STATUS_CHOICES,
+                                         default=RENDITIONS_PENDING, editable=False)
+    renditions_generated = models.PositiveSmallIntegerField(_('renditions generated'), default=0, editable=False)
+    renditions_total = models.PositiveSmallIntegerField(_('renditions total'), default=0, editable=False)
+    renditions_fingerprint = models.CharField(_('renditions fingerprint'), max_length=40, blank=True, editable=False)
+
+    @property
+    def renditions_ready(self):
+        # Renditions made by other generators or for other widths are not ready, they are rebuilt in the background
+        # (see ItemDetail) rather than generated by the page
+        from .renditions import renditions_are_current
+        return renditions_are_current(self)
 
     def get_absolute_url(self):
         return reverse_lazy('item-detail', kwargs={'pk': self.pk})
 
     def __str__(self):
         return 'Item(title={title})'.format(title=self.title)
+
+
+class ItemPayload(models.Model):
+    """A payload hidden in one of the renditions of an Item, recorded when the rendition is generated, so that the
+    Items that carry a payload can be found without scanning their images."""
+
+    item = models.ForeignKey(Item, on_delete=models.CASCADE, related_name='payloads', verbose_name=_('item'))
+    generator_id = models.CharField(_('generator id'), max_length=100)
+    engine = models.CharField(_('engine'), max_length=16)
+    payload = models.TextField(_('payload'))
+    payload_hash = models.CharField(_('payload hash'), max_length=64, db_index=True)
+    name = models.CharField(_('rendition name'), max_length=255)
+
+    class Meta:
+        unique_together = ('item', 'generator_id')
+
+    def __str__(self):
+        return 'ItemPayload(item={item}, generator_id={generator_id})'.format(item=self.item_id,
+                                                                              generator_id=self.generator_id)
+
+
+class RenditionFile(models.Model):
+    """A rendition (imagekit cache file) known to exist in the storage, along with its dimensions, so that rendering
+    it doesn't require checking the storage."""
+
+    name = models.CharField(_('name'), max_length=255, unique=True)
+    width = models.PositiveIntegerField(_('width'))
+    height = models.PositiveIntegerField(_('height'))
+
+    def __str__(self):
+        return 'RenditionFile(name={name})'.format(name=self.name)
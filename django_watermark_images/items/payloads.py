@@ -0,0 +1,88 @@
+import hashlib
+import os
+
+from itertools import repeat
+
+from PIL import Image
+
+from .executors import create_process_pool, get_worker_count
+from .models import Item, ItemPayload
+from .processors import HiddenWatermarkProcessor, scan_image
+
+
+def get_payload_text(payload):
+    return payload.hex() if isinstance(payload, bytes) else payload
+
+
+def _get_payload_hash(payload):
+    return hashlib.sha256(get_payload_text(payload).encode('utf-8')).hexdigest()
+
+
+def index_payloads(item, generator_id, generator, name, size):
+    """Records the payload that the hidden watermark processors of a generator add to the rendition of an Item, if the
+    image (of the given size) is large enough to hold it."""
+    processors = [processor for processor in getattr(generator, 'processors', [])
+                  if isinstance(processor, HiddenWatermarkProcessor)]
+
+    if not processors or not processors[-1].fits(size):
+        ItemPayload.objects.filter(item=item, generator_id=generator_id).delete()
+        return
+
+    # A later processor would overwrite the payload of an earlier one
+    processor = processors[-1]
+    ItemPayload.objects.update_or_create(item=item, generator_id=generator_id, defaults={
+        'engine': processor.engine,
+        'payload': get_payload_text(processor.text),
+        'payload_hash': _get_payload_hash(processor.text),
+        'name': name,
+    })
+
+
+def find_items(payload):
+    return Item.objects.filter(payloads__payload_hash=_get_payload_hash(payload)).distinct().order_by('pk')
+
+
+def iter_image_paths(paths):
+    Image.init()
+
+    for path in paths:
+        if os.path.isfile(path):
+            yield path
+            continue
+
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+
+            for filename in sorted(filenames):
+                if os.path.splitext(filename)[1].lower() in Image.EXTENSION:
+                    yield os.path.join(dirpath, filename)
+
+
+def _scan_path(path, engines):
+    try:
+        with open(path, 'rb') as fp:
+            return path, scan_image(fp, engines=engines), None
+    except Exception as e:
+        # An image that can't be decoded (or crashes the decoder) is counted as failed, it doesn't stop the scan
+        return path, None, str(e)
+
+
+def scan_paths(paths, engines=('lsb',), workers=None, progress=None):
+    """Scans the images found in paths (files or directories) on a pool of worker processes, and yields a (path,
+    engine, payload) tuple for each image that carries a payload. The dct engine has to decode every image in full,
+    so it is only used when asked for."""
+    workers = get_worker_count(workers)
+    stats = {'scanned': 0, 'found': 0, 'failed': 0}
+
+    with create_process_pool(workers) as executor:
+        for path, result, error in executor.map(_scan_path, iter_image_paths(paths), repeat(engines), chunksize=16):
+            stats['scanned'] += 1
+
+            if error is not None:
+                stats['failed'] += 1
+            elif result is not None:
+                stats['found'] += 1
+                yield (path,) + result
+
+            if progress is not None:
+                progress(stats)
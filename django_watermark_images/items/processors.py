@@ -1,113 +1,805 @@
+import hashlib
+import math
 import numpy as np
+import struct
+import zlib
 
+from copy import copy
+from functools import lru_cache
 from io import BytesIO
-from pickle import dump, load, UnpicklingError
+from pickle import load, UnpicklingError
 
 from django.conf import settings
 from imagekit import ImageSpec, register
-from PIL import Image, ImageDraw, ImageFont, ImageMath
+from imagekit.exceptions import MissingSource
+from pilkit.processors import ProcessorPipeline
+from PIL import Image, ImageDraw, ImageFont
 
+from .compositing import composite_patch, get_composite_image
+from .encoding import encode_image, get_encoding_profile
+from .lru import LRUCache
+from .metrics import span
 
-_default_font = ImageFont.truetype('/usr/share/fonts/dejavu/DejaVuSans-Bold.ttf', 24)
 
+class ImageTooLarge(ValueError):
+    pass
 
-def add_text_overlay(image, text, font=_default_font):
-    rgba_image = image.convert('RGBA')
-    text_overlay = Image.new('RGBA', rgba_image.size, (255, 255, 255, 0))
-    image_draw = ImageDraw.Draw(text_overlay)
-    text_size_x, text_size_y = image_draw.textsize(text, font=font)
-    text_xy = ((rgba_image.size[0] / 2) - (text_size_x / 2), (rgba_image.size[1] / 2) - (text_size_y / 2))
-    image_draw.text(text_xy, text, font=font, fill=(255, 255, 255, 128))
-    image_with_text_overlay = Image.alpha_composite(rgba_image, text_overlay)
 
-    return image_with_text_overlay
+def get_fit_size(size, max_size):
+    scale = min(float(max_size) / max(size), 1.0)
+    return max(int(round(size[0] * scale)), 1), max(int(round(size[1] * scale)), 1)
 
 
-def add_watermark(image, watermark):
-    rgba_image = image.convert('RGBA')
-    rgba_watermark = watermark.convert('RGBA')
+def open_image(fp, max_size=None, max_pixels=None):
+    with span('decode') as decode_span:
+        # Images that were opened but not loaded yet, like the ones of the upload forms, are decoded as they are
+        image = fp if isinstance(fp, Image.Image) else Image.open(fp)
+        decode_span.size = image.size
 
-    image_x, image_y = rgba_image.size
-    watermark_x, watermark_y = rgba_watermark.size
+        if max_pixels is not None and image.size[0] * image.size[1] > max_pixels:
+            raise ImageTooLarge('Image is too large ({width}x{height} pixels)'.format(width=image.size[0],
+                                                                                     height=image.size[1]))
+
+        resize = max_size is not None and max(image.size) > max_size
+
+        if resize:
+            # Only JPEG supports draft mode, it decodes the image at 1/2, 1/4 or 1/8 of its size
+            image.draft(image.mode, get_fit_size(image.size, max_size))
+
+        image.load()
+
+    if resize:
+        with span('resize', size=image.size):
+            image = image.resize(get_fit_size(image.size, max_size), resample=Image.ANTIALIAS)
+
+    return image
+
+
+def get_variant_widths(width):
+    """Returns the widths of the scaled down variants of a rendition width pixels wide, from the largest."""
+    return sorted((variant_width for variant_width in settings.RENDITION_WIDTHS if variant_width < width),
+                  reverse=True)
+
+
+def get_variant_image(image, width):
+    if width is None or image.size[0] <= width:
+        return image
+
+    height = max(int(round(image.size[1] * float(width) / image.size[0])), 1)
+
+    with span('resize', size=(width, height)):
+        return image.resize((width, height), resample=Image.ANTIALIAS)
+
+
+def open_source_image(source):
+    closed = source.closed
+
+    if closed:
+        source.open()
+
+    try:
+        source.seek(0)
+        return open_image(source)
+    finally:
+        if closed:
+            source.close()
+
+
+@lru_cache(maxsize=None)
+def get_file_hash(path):
+    file_hash = hashlib.sha1()
+
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(64 * 1024), b''):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def load_font(path, size):
+    return ImageFont.truetype(path, size)
+
+
+def get_font(name='default', scale=1.0):
+    path, size = settings.FONTS[name]
+    return load_font(path, max(int(round(size * scale)), 1))
+
+
+def get_font_key(font=None):
+    if font is None:
+        font = get_font()
+
+    return '{path}:{size}'.format(path=font.path, size=font.size)
+
+
+_text_overlay_fill = (255, 255, 255, 128)
+
+# Part of the fingerprint of the text overlay renditions, bumped whenever the overlay of the same text and font looks
+# different, so that the renditions made before are not reused (2: the font is scaled with the width of the variant)
+_text_overlay_version = 2
+
+_text_sprites = LRUCache(settings.TEXT_SPRITE_CACHE_MAX_BYTES)
+
+_text_size_draw = ImageDraw.Draw(Image.new('1', (1, 1)))
+
+
+@lru_cache(maxsize=1024)
+def _get_text_size(text, font):
+    return _text_size_draw.textsize(text, font=font)
+
+
+def _get_text_margin(text_size, font):
+    # Covers glyphs that are drawn past the measured text size (offsets, accents, descenders)
+    return max(text_size[1], font.size)
+
+
+def _get_text_sprite(text, font, fill, fraction):
+    key = (text, get_font_key(font), fill, fraction)
+    text_sprite = _text_sprites.get(key)
+
+    if text_sprite is None:
+        text_size_x, text_size_y = _get_text_size(text, font)
+        margin = _get_text_margin((text_size_x, text_size_y), font)
+        text_sprite = Image.new('RGBA', (text_size_x + 2 * margin, text_size_y + 2 * margin), (255, 255, 255, 0))
+        image_draw = ImageDraw.Draw(text_sprite)
+        image_draw.text((margin + fraction[0], margin + fraction[1]), text, font=font, fill=fill)
+        _text_sprites.set(key, text_sprite, text_sprite.size[0] * text_sprite.size[1] * 4)
+
+    return text_sprite
+
+
+def add_text_overlay(image, text, font=None):
+    if font is None:
+        font = get_font()
+
+    with span('convert', size=image.size):
+        result_image = get_composite_image(image)
+
+    image_x, image_y = result_image.size
+    text_size_x, text_size_y = _get_text_size(text, font)
+    text_x, text_y = (image_x / 2) - (text_size_x / 2), (image_y / 2) - (text_size_y / 2)
+    margin = _get_text_margin((text_size_x, text_size_y), font)
+
+    if text_x >= 0 and text_y >= 0:
+        # The sprite is drawn with the same sub-pixel offset the text has on the image, so that it is rendered
+        # exactly as it would be on a full-size overlay
+        left, top = int(math.floor(text_x)), int(math.floor(text_y))
+
+        with span('text-sprite'):
+            text_sprite = _get_text_sprite(text, font, _text_overlay_fill, (text_x - left, text_y - top))
+
+        with span('composite', size=text_sprite.size):
+            composite_patch(result_image, text_sprite, (left - margin, top - margin))
+    else:
+        # The text is larger than the image, it is drawn on an overlay that covers the part of the image under it
+        left, top = max(int(math.floor(text_x)) - margin, 0), max(int(math.floor(text_y)) - margin, 0)
+        right = min(int(math.ceil(text_x + text_size_x)) + margin, image_x)
+        bottom = min(int(math.ceil(text_y + text_size_y)) + margin, image_y)
+        text_overlay = Image.new('RGBA', (max(right - left, 1), max(bottom - top, 1)), (255, 255, 255, 0))
+        image_draw = ImageDraw.Draw(text_overlay)
+        image_draw.text((text_x - left, text_y - top), text, font=font, fill=_text_overlay_fill)
+
+        with span('composite', size=text_overlay.size):
+            composite_patch(result_image, text_overlay, (left, top))
+
+    return result_image
+
+
+_prepared_watermarks = LRUCache(settings.WATERMARK_CACHE_MAX_BYTES)
+
+
+def _get_watermark_key(watermark):
+    watermark_hash = hashlib.sha1(watermark.mode.encode('ascii'))
+    watermark_hash.update(struct.pack('>II', *watermark.size))
+    watermark_hash.update(watermark.tobytes())
+    return watermark_hash.hexdigest()
+
+
+def prepare_watermark(watermark, size, opacity=25, watermark_key=None):
+    if watermark_key is None:
+        watermark_key = _get_watermark_key(watermark)
+
+    key = (watermark_key, size, opacity)
+    prepared_watermark = _prepared_watermarks.get(key)
+
+    if prepared_watermark is None:
+        rgba_watermark = watermark.convert('RGBA').resize(size, resample=Image.ANTIALIAS)
+        rgba_watermark_mask = rgba_watermark.convert("L").point([min(x, opacity) for x in range(256)])
+        rgba_watermark.putalpha(rgba_watermark_mask)
+
+        prepared_watermark = (rgba_watermark, rgba_watermark_mask)
+        _prepared_watermarks.set(key, prepared_watermark, size[0] * size[1] * 5)
+
+    return prepared_watermark
+
+
+def add_watermark(image, watermark, opacity=25, watermark_key=None):
+    with span('convert', size=image.size):
+        result_image = get_composite_image(image)
+
+    image_x, image_y = result_image.size
+    watermark_x, watermark_y = watermark.size
 
     watermark_scale = max(image_x / (2.0 * watermark_x), image_y / (2.0 * watermark_y))
     new_size = (int(watermark_x * watermark_scale), int(watermark_y * watermark_scale))
-    rgba_watermark = rgba_watermark.resize(new_size, resample=Image.ANTIALIAS)
 
-    rgba_watermark_mask = rgba_watermark.convert("L").point(lambda x: min(x, 25))
-    rgba_watermark.putalpha(rgba_watermark_mask)
+    with span('watermark-resize', size=new_size):
+        rgba_watermark, rgba_watermark_mask = prepare_watermark(watermark, new_size, opacity=opacity,
+                                                                watermark_key=watermark_key)
 
     watermark_x, watermark_y = rgba_watermark.size
-    rgba_image.paste(rgba_watermark, ((image_x - watermark_x) // 2, (image_y - watermark_y) // 2), rgba_watermark_mask)
-
-    return rgba_image
-
-
-def lsb_encode(data, image):
-    bytes_io = BytesIO()
-    dump(data, file=bytes_io)
-    data_bytes = bytes_io.getvalue()
-    data_bytes_array = np.fromiter(data_bytes, dtype=np.uint8)
-    data_bits_list = np.unpackbits(data_bytes_array).tolist()
-    data_bits_list += [0] * (image.size[0] * image.size[1] - len(data_bits_list))
-    watermark = Image.frombytes(data=bytes(data_bits_list), size=image.size, mode='L')
-    red, green, blue = image.split()
-    watermarked_red = ImageMath.eval("convert(a&0xFE|b&0x1,'L')", a=red, b=watermark)
-    watermarked_image = Image.merge("RGB", (watermarked_red, green, blue))
+
+    with span('composite', size=rgba_watermark.size):
+        composite_patch(result_image, rgba_watermark, ((image_x - watermark_x) // 2, (image_y - watermark_y) // 2))
+
+    return result_image
+
+
+def _get_watermark_tile(watermark, scale, angle, spacing, opacity, watermark_key):
+    """Renders the repeating unit of a tiled watermark, as an array: two rows of rotated watermarks, the second one
+    shifted by half a watermark."""
+    key = ('tile', watermark_key, scale, angle, spacing, opacity)
+    tile = _prepared_watermarks.get(key)
+
+    if tile is None:
+        size = (max(int(watermark.size[0] * scale), 1), max(int(watermark.size[1] * scale), 1))
+        rgba_watermark, rgba_watermark_mask = prepare_watermark(watermark, size, opacity=opacity,
+                                                                watermark_key=watermark_key)
+        rotated_watermark = rgba_watermark.rotate(angle, resample=Image.BICUBIC, expand=True)
+        gap = int(round(max(rotated_watermark.size) * spacing))
+        cell_x, cell_y = rotated_watermark.size[0] + gap, rotated_watermark.size[1] + gap
+
+        tile_image = Image.new('RGBA', (cell_x, 2 * cell_y), (255, 255, 255, 0))
+
+        for xy in ((0, 0), (cell_x // 2, cell_y), (cell_x // 2 - cell_x, cell_y)):
+            tile_image.paste(rotated_watermark, xy)
+
+        tile = np.asarray(tile_image)
+        _prepared_watermarks.set(key, tile, tile.nbytes)
+
+    return tile
+
+
+def add_tiled_watermark(image, watermark, tile_size=0.2, spacing=0.5, angle=30, opacity=25, watermark_key=None):
+    """Repeats the watermark over the whole image. tile_size is the size of the watermark relative to the shorter side
+    of the image, and spacing the space between watermarks relative to their size."""
+    if watermark_key is None:
+        watermark_key = _get_watermark_key(watermark)
+
+    with span('convert', size=image.size):
+        result_image = get_composite_image(image)
+
+    image_x, image_y = result_image.size
+    # The scale is rounded so that images of similar sizes share the same tile
+    scale = max(round(tile_size * min(image_x, image_y) / max(watermark.size), 2), 0.01)
+
+    with span('watermark-tile'):
+        tile = _get_watermark_tile(watermark, scale, angle, spacing, opacity, watermark_key)
+
+    with span('composite', size=result_image.size):
+        # The tile is repeated along the columns with a single gather, and the resulting band is composited once
+        # per row of tiles, which costs the same no matter how many watermarks fit in the image
+        tile_band = Image.fromarray(tile.take(np.arange(image_x) % tile.shape[1], axis=1), 'RGBA')
+
+        for band_top in range(0, image_y, tile.shape[0]):
+            composite_patch(result_image, tile_band, (0, band_top))
+
+    return result_image
+
+
+_payload_magic = b'DWI'
+_payload_version = 1
+_payload_text = 0x01
+_payload_crc = 0x02
+_payload_header = struct.Struct('>3sBBI')
+_payload_checksum = struct.Struct('>I')
+
+
+class PayloadError(ValueError):
+    pass
+
+
+class PayloadTooLarge(ValueError):
+    pass
+
+
+def pack_payload(data, crc=True):
+    if isinstance(data, str):
+        data_bytes, flags = data.encode('utf-8'), _payload_text
+    elif isinstance(data, (bytes, bytearray)):
+        data_bytes, flags = bytes(data), 0
+    else:
+        raise TypeError('Payload must be str or bytes, not {type}'.format(type=type(data).__name__))
+
+    if crc:
+        flags |= _payload_crc
+
+    payload = _payload_header.pack(_payload_magic, _payload_version, flags, len(data_bytes)) + data_bytes
+
+    if crc:
+        payload += _payload_checksum.pack(zlib.crc32(data_bytes) & 0xFFFFFFFF)
+
+    return payload
+
+
+def _unpack_payload_header(header_bytes):
+    magic, version, flags, length = _payload_header.unpack(header_bytes)
+
+    if magic != _payload_magic:
+        raise PayloadError('Missing payload magic number')
+
+    if version != _payload_version:
+        raise PayloadError('Unsupported payload version {version}'.format(version=version))
+
+    if flags & _payload_crc:
+        length += _payload_checksum.size
+
+    return flags, length
+
+
+def _unpack_payload_body(flags, body_bytes):
+    data_bytes = body_bytes
+
+    if flags & _payload_crc:
+        data_bytes = body_bytes[:-_payload_checksum.size]
+        checksum, = _payload_checksum.unpack(body_bytes[-_payload_checksum.size:])
+
+        if zlib.crc32(data_bytes) & 0xFFFFFFFF != checksum:
+            raise PayloadError('Payload checksum mismatch')
+
+    if flags & _payload_text:
+        try:
+            return data_bytes.decode('utf-8')
+        except UnicodeDecodeError:
+            raise PayloadError('Payload text is not valid UTF-8')
+
+    return data_bytes
+
+
+def unpack_payload(payload_bytes):
+    if len(payload_bytes) < _payload_header.size:
+        raise PayloadError('Truncated payload header')
+
+    flags, length = _unpack_payload_header(payload_bytes[:_payload_header.size])
+    body_bytes = payload_bytes[_payload_header.size:_payload_header.size + length]
+
+    if len(body_bytes) != length:
+        raise PayloadError('Truncated payload')
+
+    return _unpack_payload_body(flags, body_bytes)
+
+
+_lsb_modes = ('L', 'LA', 'RGB', 'RGBA')
+
+
+def _lsb_strip(image, start, stop):
+    width = image.size[0]
+    top, bottom = start // width, -(-stop // width)
+    return top * width, image.crop((0, top, width, bottom))
+
+
+def _lsb_read(image, offset, length):
+    start, stop = offset * 8, (offset + length) * 8
+
+    if stop > image.size[0] * image.size[1]:
+        raise PayloadError('Payload does not fit in the image')
+
+    strip_start, strip = _lsb_strip(image, start, stop)
+    strip_array = np.asarray(strip)
+    red = strip_array[..., 0] if strip_array.ndim == 3 else strip_array
+    data_bits = red.reshape(-1)[start - strip_start:stop - strip_start] & 0x1
+    return np.packbits(data_bits).tobytes()
+
+
+def _lsb_decode_pickle(image):
+    try:
+        return load(BytesIO(_lsb_read(image, 0, image.size[0] * image.size[1] // 8)))
+    except (UnpicklingError, EOFError, ValueError, TypeError, AttributeError, ImportError, IndexError):
+        return ''
+
+
+def _lsb_fits(payload, size):
+    return len(payload) * 8 <= size[0] * size[1]
+
+
+def lsb_encode(data, image, crc=True):
+    data_bytes = pack_payload(data, crc=crc)
+    data_bits = np.unpackbits(np.frombuffer(data_bytes, dtype=np.uint8))
+
+    if not _lsb_fits(data_bytes, image.size):
+        raise PayloadTooLarge('Image is too small to hold {size} bytes'.format(size=len(data_bytes)))
+
+    # The bits are written to the first band, so images with a single or a luminance band keep their mode
+    if image.mode in _lsb_modes:
+        watermarked_image = image.copy()
+    else:
+        watermarked_image = get_composite_image(image)
+
+    strip_start, strip = _lsb_strip(watermarked_image, 0, data_bits.size)
+    strip_array = np.array(strip)
+    red = strip_array[..., 0] if strip_array.ndim == 3 else strip_array
+    red.flat[:data_bits.size] = (red.flat[:data_bits.size] & 0xFE) | data_bits
+
+    watermarked_image.paste(Image.fromarray(strip_array, strip.mode), (0, 0))
     return watermarked_image
 
 
 def lsb_decode(image):
     try:
-        red, green, blue = image.split()
-        watermark = ImageMath.eval("(a&0x1)*0x01", a=red)
-        watermark = watermark.convert('L')
-        watermark_bytes = bytes(watermark.getdata())
-        watermark_bits_array = np.fromiter(watermark_bytes, dtype=np.uint8)
-        watermark_bytes_array = np.packbits(watermark_bits_array)
-        watermark_bytes = bytes(watermark_bytes_array)
-        bytes_io = BytesIO(watermark_bytes)
-        return load(bytes_io)
-    except UnpicklingError:
+        flags, length = _unpack_payload_header(_lsb_read(image, 0, _payload_header.size))
+        return _unpack_payload_body(flags, _lsb_read(image, _payload_header.size, length))
+    except PayloadError:
+        if settings.STEGANOGRAPHY_LEGACY_PICKLE:
+            return _lsb_decode_pickle(image)
+
+        return ''
+
+
+_dct_size = 8
+_dct_coefficient = (1, 2)
+_dct_step = 28
+_dct_seed = 0x445749
+_dct_repetitions = 32
+_dct_min_repetitions = 3
+
+
+def _get_dct_matrix():
+    n = np.arange(_dct_size)
+    dct_matrix = np.sqrt(2.0 / _dct_size) * np.cos((2 * n[np.newaxis, :] + 1) * n[:, np.newaxis] * np.pi /
+                                                   (2 * _dct_size))
+    dct_matrix[0] /= np.sqrt(2)
+    return dct_matrix.astype(np.float32)
+
+
+_dct_matrix = _get_dct_matrix()
+
+# Pixel pattern of a unit change of the coefficient
+_dct_basis = np.outer(_dct_matrix[_dct_coefficient[0]], _dct_matrix[_dct_coefficient[1]])
+
+
+@lru_cache(maxsize=8)
+def _get_dct_block_order(block_count):
+    # Blocks are shuffled so that the repetitions of each bit are spread over the whole image
+    return np.random.RandomState(_dct_seed).permutation(block_count)
+
+
+def _get_dct_layout(size, header_bit_count, body_bit_count=None):
+    """Returns the blocks that carry the payload header and, once its length is known, the ones that carry its body.
+    The header gets at most a quarter of the blocks."""
+    block_columns = size[0] // _dct_size
+    block_order = _get_dct_block_order(block_columns * (size[1] // _dct_size))
+    header_count = min(block_order.size // 4, header_bit_count * _dct_repetitions)
+
+    if body_bit_count is None:
+        return block_order[:header_count], None
+
+    body_count = min(block_order.size - header_count, body_bit_count * _dct_repetitions)
+    return block_order[:header_count], block_order[header_count:header_count + body_count]
+
+
+def _get_dct_block_view(array, blocks):
+    """Returns a (block rows, 8, block columns, 8, ...) view of the array, and the index of the blocks in it. Indexing
+    the view gives the blocks in a (blocks, 8, 8, ...) layout."""
+    block_rows, block_columns = array.shape[0] // _dct_size, array.shape[1] // _dct_size
+    view = array[:block_rows * _dct_size, :block_columns * _dct_size].reshape(
+        (block_rows, _dct_size, block_columns, _dct_size) + array.shape[2:]
+    )
+    rows, columns = np.divmod(blocks, block_columns)
+    return view, (rows, slice(None), columns)
+
+
+def _get_dct_coefficients(blocks):
+    blocks = blocks.astype(np.float32)
+    return np.tensordot(np.tensordot(blocks, _dct_matrix[_dct_coefficient[1]], axes=([2], [0])),
+                        _dct_matrix[_dct_coefficient[0]], axes=([1], [0]))
+
+
+def _spread_bits(bits, count):
+    return bits[np.arange(count) % bits.size] if bits.size else np.zeros(count, dtype=np.uint8)
+
+
+def _read_dct_bits(luma, blocks, bit_count):
+    view, index = _get_dct_block_view(luma, blocks)
+    coefficients = _get_dct_coefficients(view[index])
+    block_bits = np.round(coefficients / (_dct_step / 2.0)).astype(np.int64) & 0x1
+    votes = np.bincount(np.arange(block_bits.size) % bit_count, weights=block_bits * 2.0 - 1, minlength=bit_count)
+    return np.packbits((votes > 0).astype(np.uint8)).tobytes()
+
+
+def _dct_fits(payload, size):
+    header_bit_count, body_bit_count = _payload_header.size * 8, (len(payload) - _payload_header.size) * 8
+    header_blocks, body_blocks = _get_dct_layout(size, header_bit_count, body_bit_count)
+    return (header_blocks.size >= header_bit_count * _dct_min_repetitions and
+            body_blocks.size >= body_bit_count * _dct_min_repetitions)
+
+
+def dct_encode(data, image, crc=True):
+    """Hides data in a DCT coefficient of the luma of 8x8 blocks, aligned with the ones of JPEG, so that it survives
+    lossy recompression. Each bit is quantized into the coefficient of many blocks (quantization index modulation),
+    and decoded by majority."""
+    payload = pack_payload(data, crc=crc)
+    header_bits = np.unpackbits(np.frombuffer(payload[:_payload_header.size], dtype=np.uint8))
+    body_bits = np.unpackbits(np.frombuffer(payload[_payload_header.size:], dtype=np.uint8))
+
+    if not _dct_fits(payload, image.size):
+        raise PayloadTooLarge('Image is too small to hold {size} bytes'.format(size=len(payload)))
+
+    header_blocks, body_blocks = _get_dct_layout(image.size, header_bits.size, body_bits.size)
+
+    if image.mode not in ('RGB', 'RGBA', 'L'):
+        image = get_composite_image(image)
+
+    image_array = np.array(image)
+    view, index = _get_dct_block_view(image_array, np.concatenate((header_blocks, body_blocks)))
+    blocks = view[index].astype(np.int16)
+
+    if image.mode == 'L':
+        blocks = blocks[..., np.newaxis]
+        luma = blocks[..., 0]
+    else:
+        # ITU-R 601-2 luma, the same as Pillow and JPEG use
+        luma = np.tensordot(blocks[..., :3], np.array([0.299, 0.587, 0.114], dtype=np.float32), axes=([3], [0]))
+
+    coefficients = _get_dct_coefficients(luma)
+    bits = np.concatenate((_spread_bits(header_bits, header_blocks.size), _spread_bits(body_bits, body_blocks.size)))
+
+    half_step = _dct_step / 2.0
+    quantized = np.round((coefficients - bits * half_step) / _dct_step) * _dct_step + bits * half_step
+    pattern = np.round((quantized - coefficients)[:, np.newaxis, np.newaxis] * _dct_basis).astype(np.int16)
+
+    # The pattern is added to every color band, which adds it to the luma and leaves the chroma unchanged
+    color_blocks = blocks[..., :3] + pattern[..., np.newaxis]
+    # Blocks that would be clipped are shifted instead, which only changes their DC coefficient
+    color_blocks -= np.maximum(color_blocks.max(axis=1).max(axis=1) - 255, 0)[:, np.newaxis, np.newaxis]
+    color_blocks += np.maximum(-color_blocks.min(axis=1).min(axis=1), 0)[:, np.newaxis, np.newaxis]
+    blocks[..., :3] = np.clip(color_blocks, 0, 255)
+
+    view[index] = blocks[..., 0] if image.mode == 'L' else blocks
+    return Image.fromarray(image_array, image.mode)
+
+
+def dct_decode(image):
+    luma = np.asarray(image.convert('L'))
+    header_bit_count = _payload_header.size * 8
+    header_blocks, body_blocks = _get_dct_layout(image.size, header_bit_count)
+
+    try:
+        if header_blocks.size < header_bit_count:
+            raise PayloadError('Payload does not fit in the image')
+
+        flags, length = _unpack_payload_header(_read_dct_bits(luma, header_blocks, header_bit_count))
+        header_blocks, body_blocks = _get_dct_layout(image.size, header_bit_count, length * 8)
+
+        if body_blocks.size < length * 8:
+            raise PayloadError('Payload does not fit in the image')
+
+        return _unpack_payload_body(flags, _read_dct_bits(luma, body_blocks, length * 8) if length else b'')
+    except PayloadError:
         return ''
 
 
+_hidden_watermark_engines = {
+    'lsb': (lsb_encode, _lsb_fits),
+    'dct': (dct_encode, _dct_fits),
+}
+
+
+def hidden_watermark_encode(data, image, engine='lsb'):
+    return _hidden_watermark_engines[engine][0](data, image)
+
+
+def hidden_watermark_fits(data, size, engine='lsb'):
+    return _hidden_watermark_engines[engine][1](pack_payload(data), size)
+
+
+def hidden_watermark_decode(image):
+    return lsb_decode(image) or dct_decode(image)
+
+
+def _decodes_rows(image):
+    # Only non-interlaced PNG images can be decoded partially, from the top
+    return image.format == 'PNG' and not image.info.get('interlace') and len(image.tile) == 1
+
+
+def _open_rows(fp, byte_count):
+    """Opens an image so that loading it only decodes the rows that hold the first byte_count bytes of an LSB payload,
+    leaving the rest blank, if the format allows it."""
+    fp.seek(0)
+    image = Image.open(fp)
+
+    if _decodes_rows(image):
+        decoder, extents, offset, args = image.tile[0]
+        bottom = min(extents[3], extents[1] + -(-byte_count * 8 // image.size[0]))
+        image.tile = [(decoder, (extents[0], extents[1], extents[2], bottom), offset, args)]
+
+    return image
+
+
+def scan_image(fp, engines=('lsb', 'dct')):
+    """Looks for a payload in an image file, and returns an (engine, payload) tuple or None. The header of an LSB
+    payload is read first, from the first rows of the image, and its body only if the header is valid. DCT payloads
+    are spread over the whole image, which has to be decoded, but their body is only read if their header is valid
+    too."""
+    image = _open_rows(fp, _payload_header.size)
+    partial = _decodes_rows(image)
+
+    if 'lsb' in engines:
+        try:
+            flags, length = _unpack_payload_header(_lsb_read(image, 0, _payload_header.size))
+
+            if partial:
+                image = _open_rows(fp, _payload_header.size + length)
+
+            return 'lsb', _unpack_payload_body(flags, _lsb_read(image, _payload_header.size, length))
+        except PayloadError:
+            pass
+
+    if 'dct' in engines:
+        if partial:
+            fp.seek(0)
+            image = Image.open(fp)
+
+        payload = dct_decode(image)
+
+        if payload:
+            return 'dct', payload
+
+    return None
+
+
 class TextOverlayProcessor(object):
-    font = ImageFont.truetype('/usr/share/fonts/dejavu/DejaVuSans-Bold.ttf', 36)
+    text = 'django-watermark-images'
+    font_name = 'text-overlay'
+    scale = 1.0
+
+    @property
+    def fingerprint(self):
+        font = get_font(self.font_name)
+        return 'text-overlay:{version}:{text!r}:{font_key}:{font_hash}'.format(version=_text_overlay_version,
+                                                                               text=self.text,
+                                                                               font_key=get_font_key(font),
+                                                                               font_hash=get_file_hash(font.path))
+
+    def scaled(self, scale):
+        processor = copy(self)
+        processor.scale = scale
+        return processor
 
     def process(self, image):
-        return add_text_overlay(image, 'django-watermark-images', font=self.font)
+        return add_text_overlay(image, self.text, font=get_font(self.font_name, scale=self.scale))
 
 
 class WatermarkProcessor(object):
     watermark = Image.open(settings.WATERMARK_IMAGE)
 
+    @property
+    def fingerprint(self):
+        return 'watermark:{watermark_hash}'.format(watermark_hash=get_file_hash(settings.WATERMARK_IMAGE))
+
     def process(self, image):
-        return add_watermark(image, self.watermark)
+        return add_watermark(image, self.watermark, watermark_key=settings.WATERMARK_IMAGE)
+
+
+class TiledWatermarkProcessor(WatermarkProcessor):
+    @property
+    def fingerprint(self):
+        return 'tiled-{fingerprint}:{tile}'.format(fingerprint=super().fingerprint,
+                                                   tile=sorted(settings.WATERMARK_TILE.items()))
+
+    def process(self, image):
+        return add_tiled_watermark(image, self.watermark, watermark_key=settings.WATERMARK_IMAGE,
+                                   **settings.WATERMARK_TILE)
 
 
 class HiddenWatermarkProcessor(object):
+    text = 'django-watermark-images'
+
+    def __init__(self, engine='lsb'):
+        self.engine = engine
+
+    @property
+    def fingerprint(self):
+        return 'hidden-watermark:{engine}:{text!r}'.format(engine=self.engine, text=self.text)
+
+    def fits(self, size):
+        return hidden_watermark_fits(self.text, size, engine=self.engine)
+
     def process(self, image):
-        return lsb_encode('django-watermark-images', image)
+        # Images too small to hold the payload are left without it, rather than failing the whole spec
+        if not self.fits(image.size):
+            return image
+
+        return hidden_watermark_encode(self.text, image, engine=self.engine)
+
+
+class EncodedImageSpec(ImageSpec):
+    """Spec whose output format and options are taken from an encoding profile (see ENCODING_PROFILES).
+
+    With a width, it generates a variant of the rendition scaled down to that width. The variants generated together
+    can share the decoded source image, passed as source_image along with the width of the full size source (if it
+    was scaled down already). Processors whose output depends on the resolution (those with a scaled method, like the
+    text overlay) are scaled along with the variant, so that every variant shows the same picture.
+    """
+
+    encoding_profile = None
+    lossless = False
+
+    def __init__(self, source, width=None, source_image=None, source_width=None):
+        super().__init__(source)
+        self.width = width
+        self.source_image = source_image
+        self.source_width = source_width
 
+    def _get_processors(self, scale):
+        if scale == 1.0:
+            return self.processors
 
-class TextOverlay(ImageSpec):
+        return [processor.scaled(scale) if hasattr(processor, 'scaled') else processor
+                for processor in self.processors]
+
+    @property
+    def format(self):
+        return get_encoding_profile(self.encoding_profile, lossless=self.lossless)['format']
+
+    @property
+    def options(self):
+        return get_encoding_profile(self.encoding_profile, lossless=self.lossless).get('options', {})
+
+    def get_fingerprint(self):
+        return ';'.join(getattr(processor, 'fingerprint', type(processor).__name__) for processor in self.processors)
+
+    def get_hash(self):
+        # The processors are hashed by pickling them, which misses the fonts, files and settings they depend on. Their
+        # fingerprints are added, so that changing any of them renames the cache files.
+        spec_hash = '{hash}:{width}:{fingerprint}'.format(hash=super().get_hash(), width=self.width,
+                                                          fingerprint=self.get_fingerprint())
+        return hashlib.md5(spec_hash.encode('utf-8')).hexdigest()
+
+    def generate(self):
+        image = self.source_image
+
+        if image is None:
+            if not self.source:
+                raise MissingSource("The spec '{spec}' has no source file associated with it.".format(spec=self))
+
+            image = open_source_image(self.source)
+
+        source_width = self.source_width or image.size[0]
+        image = get_variant_image(image, self.width)
+        image = ProcessorPipeline(self._get_processors(float(image.size[0]) / source_width)).process(image)
+        image_bytes, content_type = encode_image(image, self.encoding_profile, lossless=self.lossless)
+        return BytesIO(image_bytes)
+
+
+class TextOverlay(EncodedImageSpec):
     processors = [TextOverlayProcessor()]
-    format = 'JPEG'
-    options = {'quality': 75}
+    encoding_profile = 'text-overlay'
 
 
-class Watermark(ImageSpec):
+class Watermark(EncodedImageSpec):
     processors = [WatermarkProcessor()]
-    format = 'JPEG'
-    options = {'quality': 75}
+    encoding_profile = 'watermark'
+
 
+class TiledWatermark(EncodedImageSpec):
+    processors = [TiledWatermarkProcessor()]
+    encoding_profile = 'watermark'
 
-class HiddenWatermark(ImageSpec):
+
+class HiddenWatermark(EncodedImageSpec):
     processors = [HiddenWatermarkProcessor()]
-    format = 'PNG'
+    encoding_profile = 'steganography'
+    lossless = True
+
+
+class RobustHiddenWatermark(EncodedImageSpec):
+    processors = [HiddenWatermarkProcessor(engine='dct')]
+    encoding_profile = 'robust-steganography'
 
 
 register.generator('items:text-overlay', TextOverlay)
 register.generator('items:watermark', Watermark)
+register.generator('items:tiled-watermark', TiledWatermark)
 register.generator('items:hidden-watermark', HiddenWatermark)
+register.generator('items:robust-hidden-watermark', RobustHiddenWatermark)
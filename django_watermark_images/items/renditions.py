@@ -0,0 +1,206 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from imagekit.cachefiles import ImageCacheFile
+from imagekit.registry import generator_registry
+
+from . import processors  # noqa: registers the items:* generators
+from .cachefiles import unindex_rendition
+from .executors import create_process_pool, get_worker_count, warm_up
+from .models import Item
+from .payloads import index_payloads
+from .processors import get_variant_image, get_variant_widths, open_source_image
+
+
+logger = logging.getLogger(__name__)
+
+_executor = ThreadPoolExecutor(max_workers=settings.RENDITION_WORKERS)
+
+
+def get_rendition_generator_ids():
+    return sorted(generator_id for generator_id in generator_registry.get_ids() if generator_id.startswith('items:'))
+
+
+@lru_cache(maxsize=1)
+def get_renditions_fingerprint():
+    fingerprint = hashlib.sha1()
+
+    for generator_id in get_rendition_generator_ids():
+        fingerprint.update(generator_id.encode('utf-8'))
+        fingerprint.update(generator_registry.get(generator_id, source=None).get_fingerprint().encode('utf-8'))
+
+    fingerprint.update(json.dumps(settings.RENDITION_WIDTHS).encode('utf-8'))
+
+    return fingerprint.hexdigest()
+
+
+def renditions_are_current(item):
+    return (item.renditions_status == Item.RENDITIONS_DONE and
+            item.renditions_fingerprint == get_renditions_fingerprint())
+
+
+def _delete_cache_file(cache_file):
+    # The storage would save the new file under another name rather than replacing the existing one
+    if cache_file.storage.exists(cache_file.name):
+        cache_file.storage.delete(cache_file.name)
+
+    unindex_rendition(cache_file.name)
+
+
+def _generate_rendition(item, generator_id, width, variant_image, source_width, force):
+    generator = generator_registry.get(generator_id, source=item.image, width=width, source_image=variant_image,
+                                       source_width=source_width)
+    cache_file = ImageCacheFile(generator)
+
+    if force:
+        _delete_cache_file(cache_file)
+
+    cache_file.generate(force=force)
+
+    if width is None:
+        index_payloads(item, generator_id, generator, cache_file.name, variant_image.size)
+
+
+def generate_renditions(item_pk, force=False):
+    close_old_connections()
+
+    try:
+        item = Item.objects.get(pk=item_pk)
+        items = Item.objects.filter(pk=item_pk)
+        items.update(renditions_status=Item.RENDITIONS_RUNNING, renditions_generated=0)
+
+        # The source is decoded once, and every variant is scaled down from the previous (larger) one and shared by
+        # all the generators
+        generator_ids = get_rendition_generator_ids()
+        variant_image = open_source_image(item.image)
+        source_width = variant_image.size[0]
+        widths = [None] + get_variant_widths(source_width)
+        items.update(renditions_total=len(generator_ids) * len(widths))
+        failed = False
+
+        for width in widths:
+            variant_image = get_variant_image(variant_image, width)
+
+            for generator_id in generator_ids:
+                # A failing generator doesn't keep the others from generating their renditions
+                try:
+                    _generate_rendition(item, generator_id, width, variant_image, source_width, force)
+                except Exception:
+                    logger.exception('Unable to generate the %s rendition (width %s) of item %s', generator_id, width,
+                                     item_pk)
+                    failed = True
+                else:
+                    items.update(renditions_generated=F('renditions_generated') + 1)
+
+        if failed:
+            items.update(renditions_status=Item.RENDITIONS_FAILED)
+            return False
+
+        items.update(renditions_status=Item.RENDITIONS_DONE, renditions_fingerprint=get_renditions_fingerprint())
+        return True
+    except Item.DoesNotExist:
+        return False
+    except Exception:
+        logger.exception('Unable to generate the renditions of item %s', item_pk)
+        Item.objects.filter(pk=item_pk).update(renditions_status=Item.RENDITIONS_FAILED)
+        return False
+    finally:
+        close_old_connections()
+
+
+def schedule_renditions(item):
+    Item.objects.filter(pk=item.pk).update(renditions_status=Item.RENDITIONS_QUEUED, renditions_generated=0,
+                                           renditions_total=len(get_rendition_generator_ids()) *
+                                           (len(settings.RENDITION_WIDTHS) + 1))
+    transaction.on_commit(lambda: _executor.submit(generate_renditions, item.pk))
+
+
+def _regenerate_renditions(item_pk):
+    if not generate_renditions(item_pk, force=True):
+        return None
+
+    try:
+        return Item.objects.get(pk=item_pk).image.size
+    finally:
+        close_old_connections()
+
+
+def _load_checkpoint(checkpoint_path):
+    try:
+        with open(checkpoint_path) as fp:
+            checkpoint = json.load(fp)
+    except (IOError, ValueError):
+        return 0
+
+    return checkpoint['last_pk'] if checkpoint.get('fingerprint') == get_renditions_fingerprint() else 0
+
+
+def _save_checkpoint(checkpoint_path, last_pk):
+    with open(checkpoint_path + '.tmp', 'w') as fp:
+        json.dump({'fingerprint': get_renditions_fingerprint(), 'last_pk': last_pk}, fp)
+
+    os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+
+def regenerate_renditions(workers=None, force=False, checkpoint_path=None, progress=None):
+    workers = get_worker_count(workers)
+    last_pk = _load_checkpoint(checkpoint_path) if checkpoint_path else 0
+    stats = {'processed': 0, 'skipped': 0, 'failed': 0, 'bytes': 0}
+    started = time.time()
+
+    def finish(item_pk, future):
+        size = future.result()
+
+        if size is None:
+            stats['failed'] += 1
+        else:
+            stats['processed'] += 1
+            stats['bytes'] += size
+
+        if checkpoint_path:
+            _save_checkpoint(checkpoint_path, item_pk)
+
+        if progress is not None:
+            progress(stats)
+
+    with create_process_pool(workers) as executor:
+        wait([executor.submit(warm_up) for _ in range(workers)])
+
+        pending = deque()
+        items = Item.objects.filter(pk__gt=last_pk).order_by('pk').only('pk', 'renditions_status',
+                                                                        'renditions_fingerprint')
+
+        for item in items.iterator():
+            if not force and renditions_are_current(item):
+                stats['skipped'] += 1
+
+                if not pending and checkpoint_path:
+                    _save_checkpoint(checkpoint_path, item.pk)
+
+                continue
+
+            pending.append((item.pk, executor.submit(_regenerate_renditions, item.pk)))
+
+            while pending and (len(pending) >= 2 * workers or pending[0][1].done()):
+                finish(*pending.popleft())
+
+        while pending:
+            finish(*pending.popleft())
+
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    stats['seconds'] = time.time() - started
+    stats['images_per_second'] = stats['processed'] / stats['seconds'] if stats['seconds'] else 0.0
+    stats['megabytes_per_second'] = stats['bytes'] / 1e6 / stats['seconds'] if stats['seconds'] else 0.0
+    return stats
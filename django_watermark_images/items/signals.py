@@ -0,0 +1,26 @@
+from django.db.models.signals import post_init, post_save
+from django.dispatch import receiver
+
+from .models import Item
+from .renditions import schedule_renditions
+
+
+def _get_image_name(instance):
+    # Read from the instance's dict, so that a deferred image isn't loaded
+    image = instance.__dict__.get('image')
+    return getattr(image, 'name', image)
+
+
+@receiver(post_init, sender=Item)
+def item_loaded(sender, instance, **kwargs):
+    instance._saved_image_name = _get_image_name(instance)
+
+
+@receiver(post_save, sender=Item)
+def item_saved(sender, instance, created, update_fields=None, **kwargs):
+    image_name = _get_image_name(instance)
+
+    if created or image_name != instance._saved_image_name or (update_fields is not None and 'image' in update_fields):
+        schedule_renditions(instance)
+
+    instance._saved_image_name = image_name
@@ -0,0 +1,268 @@
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+
+from datetime import datetime
+from io import BytesIO
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .lru import LRUCache
+
+
+logger = logging.getLogger(__name__)
+
+_chunk_size = 64 * 1024
+
+
+class ResultStore(object):
+    """Stores encoded images along with their metadata (content_type, etag, last_modified and size)."""
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+
+    def save(self, key, image_bytes, content_type):
+        raise NotImplementedError()
+
+    def save_file(self, key, fp, content_type):
+        return self.save(key, fp.read(), content_type)
+
+    def get_meta(self, key):
+        raise NotImplementedError()
+
+    def open(self, key):
+        raise NotImplementedError()
+
+    def get_relative_path(self, key):
+        """Returns the path of the image relative to the location of the store, for stores that keep their images in
+        files that the web server can serve."""
+        return None
+
+    def touch(self, key):
+        """Restarts the TTL of an image that is used again. Returns False if the image doesn't exist."""
+        raise NotImplementedError()
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+    def sweep(self):
+        raise NotImplementedError()
+
+    def _create_meta(self, content_type, etag, size):
+        return {
+            'content_type': content_type,
+            'etag': etag,
+            'last_modified': timezone.now(),
+            'size': size
+        }
+
+    def _is_expired(self, created):
+        return self.ttl is not None and created < time.time() - self.ttl
+
+
+class FileSystemResultStore(ResultStore):
+    """Stores every image in its own file, sharded in sub-directories by the hash of its key.
+
+    Files are written to a temporary file and then renamed, so readers never see a partially written image.
+    """
+
+    def __init__(self, location, ttl=None):
+        super().__init__(ttl=ttl)
+        self.location = location
+
+    def _get_path(self, key):
+        key_hash = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.location, key_hash[:2], key_hash[2:4], key_hash)
+
+    def _get_meta_path(self, key):
+        return '{path}.json'.format(path=self._get_path(key))
+
+    def _write(self, path, chunks):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                for chunk in chunks:
+                    fp.write(chunk)
+
+            os.replace(temp_path, path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+    def _write_meta(self, key, meta):
+        # The metadata is written last, an image only exists once its metadata does
+        self._write(self._get_meta_path(key), [json.dumps(
+            dict(meta, last_modified=meta['last_modified'].timestamp())
+        ).encode('utf-8')])
+        return meta
+
+    def save(self, key, image_bytes, content_type):
+        self._write(self._get_path(key), [image_bytes])
+        return self._write_meta(key, self._create_meta(content_type, hashlib.sha1(image_bytes).hexdigest(),
+                                                       len(image_bytes)))
+
+    def save_file(self, key, fp, content_type):
+        """Copies the file to the store chunk by chunk, without reading it all in memory."""
+        etag_hash = hashlib.sha1()
+        chunk_sizes = []
+
+        def read_chunks():
+            for chunk in iter(lambda: fp.read(_chunk_size), b''):
+                etag_hash.update(chunk)
+                chunk_sizes.append(len(chunk))
+                yield chunk
+
+        self._write(self._get_path(key), read_chunks())
+        return self._write_meta(key, self._create_meta(content_type, etag_hash.hexdigest(), sum(chunk_sizes)))
+
+    def get_meta(self, key):
+        try:
+            with open(self._get_meta_path(key), 'rb') as fp:
+                meta = json.loads(fp.read().decode('utf-8'))
+        except (OSError, ValueError):
+            return None
+
+        meta['last_modified'] = datetime.fromtimestamp(meta['last_modified'], timezone.utc)
+        return meta
+
+    def open(self, key):
+        try:
+            return open(self._get_path(key), 'rb')
+        except OSError:
+            return None
+
+    def get_relative_path(self, key):
+        return os.path.relpath(self._get_path(key), self.location).replace(os.sep, '/')
+
+    def touch(self, key):
+        # The sweeper goes by the modification time of the files, the metadata (and Last-Modified) doesn't change
+        try:
+            for path in (self._get_meta_path(key), self._get_path(key)):
+                os.utime(path)
+        except OSError:
+            return False
+
+        return True
+
+    def delete(self, key):
+        for path in (self._get_meta_path(key), self._get_path(key)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def sweep(self):
+        swept = 0
+
+        for directory, directory_names, file_names in os.walk(self.location):
+            for file_name in file_names:
+                path = os.path.join(directory, file_name)
+
+                try:
+                    if self._is_expired(os.path.getmtime(path)):
+                        os.remove(path)
+                        swept += 1
+                except OSError:
+                    pass
+
+        return swept
+
+
+class MemoryResultStore(ResultStore):
+    """Keeps the images in a process local LRU cache. Meant for tests and single process development servers."""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=None):
+        super().__init__(ttl=ttl)
+        self._images = LRUCache(max_bytes)
+
+    def save(self, key, image_bytes, content_type):
+        meta = self._create_meta(content_type, hashlib.sha1(image_bytes).hexdigest(), len(image_bytes))
+        self._images.set(key, (image_bytes, meta, time.time()), len(image_bytes))
+        return meta
+
+    def get_meta(self, key):
+        image = self._images.get(key)
+        return image[1] if image is not None else None
+
+    def open(self, key):
+        image = self._images.get(key)
+        return BytesIO(image[0]) if image is not None else None
+
+    def touch(self, key):
+        image = self._images.get(key)
+
+        if image is None:
+            return False
+
+        self._images.set(key, image[:2] + (time.time(),), len(image[0]))
+        return True
+
+    def delete(self, key):
+        self._images.delete(key)
+
+    def sweep(self):
+        expired_keys = [key for key, (image_bytes, meta, saved) in self._images.items() if self._is_expired(saved)]
+
+        for key in expired_keys:
+            self._images.delete(key)
+
+        return len(expired_keys)
+
+
+def _run_sweeper(result_store, interval):
+    while True:
+        time.sleep(interval)
+
+        try:
+            logger.debug('Swept %d expired results', result_store.sweep())
+        except Exception:
+            logger.exception('Unable to sweep the result store')
+
+
+def _create_result_store():
+    options = settings.RESULT_STORE
+    result_store = import_string(options['BACKEND'])(ttl=options.get('TTL'), **options.get('OPTIONS', {}))
+
+    # The worker processes of the pools (see create_process_pool) leave the sweeping to the process that started them
+    if (result_store.ttl is not None and options.get('SWEEP_INTERVAL') is not None and
+            multiprocessing.current_process().name == 'MainProcess'):
+        thread = threading.Thread(target=_run_sweeper, args=(result_store, options['SWEEP_INTERVAL']))
+        thread.daemon = True
+        thread.start()
+
+    return result_store
+
+
+_result_store = None
+_result_store_lock = threading.Lock()
+
+
+def get_result_store():
+    global _result_store
+
+    if _result_store is None:
+        with _result_store_lock:
+            if _result_store is None:
+                _result_store = _create_result_store()
+
+    return _result_store
+
+
+@receiver(setting_changed)
+def _reset_result_store(setting, **kwargs):
+    global _result_store
+
+    if setting == 'RESULT_STORE':
+        _result_store = None
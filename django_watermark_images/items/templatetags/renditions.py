@@ -0,0 +1,57 @@
+from django import template
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+from imagekit.cachefiles import ImageCacheFile
+from imagekit.registry import generator_registry
+from imagekit.templatetags import imagekit
+
+from ..cachefiles import get_rendition_dimensions
+from ..processors import EncodedImageSpec, get_variant_widths
+
+
+register = template.Library()
+
+
+class IndexedGenerateImageTagNode(imagekit.GenerateImageTagNode):
+    """Renders the <img> tag of imagekit's generateimage, taking the dimensions of the image from the rendition index
+    instead of reading them from the cache file. Renditions with scaled down variants get a srcset."""
+
+    def _get_cache_file(self, context, **kwargs):
+        generator_kwargs = {name: value.resolve(context) for name, value in self._generator_kwargs.items()}
+        generator_kwargs.update(kwargs)
+        return ImageCacheFile(generator_registry.get(self._generator_id.resolve(context), **generator_kwargs))
+
+    def render(self, context):
+        file = self._get_cache_file(context)
+        attrs = {name: value.resolve(context) for name, value in self._html_attrs.items()}
+
+        # The url is resolved first, it generates (and indexes) the cache file if it doesn't exist yet
+        attrs['src'] = file.url
+        width, height = get_rendition_dimensions(file.name) or (file.width, file.height)
+
+        if 'width' not in attrs and 'height' not in attrs:
+            attrs['width'], attrs['height'] = width, height
+
+        if 'srcset' not in attrs and isinstance(file.generator, EncodedImageSpec):
+            srcset = ['{url} {width}w'.format(url=attrs['src'], width=width)]
+
+            for variant_width in get_variant_widths(width):
+                srcset.append('{url} {width}w'.format(url=self._get_cache_file(context, width=variant_width).url,
+                                                      width=variant_width))
+
+            attrs['srcset'] = ', '.join(srcset)
+
+        return mark_safe('<img {attrs} />'.format(attrs=' '.join(
+            '{name}="{value}"'.format(name=escape(name), value=escape(value)) for name, value in sorted(attrs.items())
+        )))
+
+
+@register.tag
+def generateimage(parser, token):
+    """Same as imagekit's generateimage, which it replaces when the library is loaded after imagekit's."""
+    node = imagekit.generateimage(parser, token)
+
+    if isinstance(node, imagekit.GenerateImageTagNode):
+        return IndexedGenerateImageTagNode(node._generator_id, node._generator_kwargs, node._html_attrs)
+
+    return node
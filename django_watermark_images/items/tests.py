@@ -1,3 +1,472 @@
-from django.test import TestCase
+import os
+import shutil
+import tempfile
 
-# Create your tests here.
+from concurrent.futures import Future, ProcessPoolExecutor
+from io import BytesIO
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import resolve, reverse
+
+import numpy as np
+
+from PIL import Image, ImageDraw
+
+from .encoding import encode_image, get_encoding_stats
+from .frames import encode_gif_frame, join_gif_frames, process_frames
+from .models import Item
+from .payloads import _scan_path
+from .processors import (HiddenWatermarkProcessor, PayloadError, PayloadTooLarge, add_text_overlay, add_watermark,
+                         dct_decode, dct_encode, get_font, lsb_decode, lsb_encode, pack_payload, prepare_watermark,
+                         unpack_payload)
+from .renditions import get_renditions_fingerprint
+from .stores import _create_result_store, get_result_store
+from . import views
+from .views import _get_source_image_key, _get_upload_id, _parse_range, _save_source_upload
+
+
+class PayloadTests(SimpleTestCase):
+    def test_round_trip(self):
+        for data in ('django-watermark-images', 'ñandú', b'\x00\xffbytes', ''):
+            for crc in (True, False):
+                self.assertEqual(unpack_payload(pack_payload(data, crc=crc)), data)
+
+    def test_unsupported_type(self):
+        with self.assertRaises(TypeError):
+            pack_payload(42)
+
+    def test_truncated_header(self):
+        with self.assertRaisesRegex(PayloadError, 'Truncated payload header'):
+            unpack_payload(pack_payload('text')[:5])
+
+    def test_truncated_body(self):
+        with self.assertRaisesRegex(PayloadError, 'Truncated payload'):
+            unpack_payload(pack_payload('text')[:-1])
+
+    def test_checksum_mismatch(self):
+        payload = bytearray(pack_payload('text'))
+        payload[-5] ^= 0x01
+
+        with self.assertRaisesRegex(PayloadError, 'checksum mismatch'):
+            unpack_payload(bytes(payload))
+
+    def test_missing_magic(self):
+        with self.assertRaisesRegex(PayloadError, 'magic'):
+            unpack_payload(b'XYZ' + pack_payload('text')[3:])
+
+    def test_lsb_round_trip(self):
+        image = Image.new('RGB', (64, 64), (120, 60, 30))
+        self.assertEqual(lsb_decode(lsb_encode('django-watermark-images', image)), 'django-watermark-images')
+
+    def test_dct_round_trip(self):
+        # The payload survives a recompression as JPEG at quality 75
+        x, y = np.meshgrid(np.arange(320), np.arange(240))
+        pixels = np.dstack((x * 255 // 320, y * 255 // 240, (x + y) % 256)).astype(np.uint8)
+        image_io = BytesIO()
+        dct_encode('django-watermark-images', Image.fromarray(pixels, 'RGB')).save(image_io, 'JPEG', quality=75)
+        image_io.seek(0)
+
+        self.assertEqual(dct_decode(Image.open(image_io)), 'django-watermark-images')
+
+    def test_too_small(self):
+        image = Image.new('RGB', (64, 64), (120, 60, 30))
+
+        with self.assertRaises(PayloadTooLarge):
+            dct_encode('django-watermark-images', image)
+
+        # The renditions of small images are generated without the payload
+        for engine in ('lsb', 'dct'):
+            processor = HiddenWatermarkProcessor(engine)
+            processor.text = 'x' * 1000
+            self.assertFalse(processor.fits(image.size))
+            self.assertIs(processor.process(image), image)
+
+    def test_scan_path_error(self):
+        # Any error of the decoder is recorded for the path, rather than stopping the whole scan
+        with mock.patch('items.payloads.scan_image', side_effect=RuntimeError('decoder crashed')):
+            self.assertEqual(_scan_path(__file__, ('lsb',)), (__file__, None, 'decoder crashed'))
+
+
+class ParseRangeTests(SimpleTestCase):
+    def test_ranges(self):
+        self.assertEqual(_parse_range('bytes=0-9', 100), (0, 10))
+        self.assertEqual(_parse_range('bytes=90-', 100), (90, 100))
+        self.assertEqual(_parse_range('bytes=90-200', 100), (90, 100))
+
+    def test_suffix(self):
+        self.assertEqual(_parse_range('bytes=-10', 100), (90, 100))
+        self.assertEqual(_parse_range('bytes=-200', 100), (0, 100))
+
+    def test_reversed(self):
+        self.assertIsNone(_parse_range('bytes=5-3', 100))
+
+    def test_past_the_end(self):
+        self.assertEqual(_parse_range('bytes=100-', 100), (100, 100))
+
+    def test_invalid(self):
+        for range_header in ('bytes=-', 'bytes=1-2,4-5', 'items=0-1', 'bytes=a-b'):
+            self.assertIsNone(_parse_range(range_header, 100))
+
+
+@override_settings(RESULT_STORE={'BACKEND': 'items.stores.MemoryResultStore'})
+class CachedImageRangeTests(SimpleTestCase):
+    image_bytes = bytes(range(100))
+
+    def setUp(self):
+        get_result_store().save('test-image', self.image_bytes, 'image/png')
+        self.url = reverse('cached-image', kwargs={'key': 'test-image'})
+
+    def get(self, range_header):
+        return self.client.get(self.url, HTTP_RANGE=range_header)
+
+    def test_range(self):
+        response = self.get('bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/100')
+        self.assertEqual(b''.join(response.streaming_content), self.image_bytes[10:20])
+
+    def test_suffix(self):
+        response = self.get('bytes=-5')
+        self.assertEqual(response['Content-Range'], 'bytes 95-99/100')
+        self.assertEqual(b''.join(response.streaming_content), self.image_bytes[95:])
+
+    def test_reversed(self):
+        response = self.get('bytes=5-3')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Length'], '100')
+
+    def test_past_the_end(self):
+        response = self.get('bytes=100-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */100')
+
+
+class GifFramesTests(SimpleTestCase):
+    def create_frame(self, index, size=(60, 40)):
+        frame = Image.new('RGBA', size, (0, 0, 0, 0))
+        frame.paste((255, 0, 0, 255), (index * 15, 5, index * 15 + 15, 20))
+        return frame
+
+    def join(self, frames):
+        gif_io = BytesIO()
+        join_gif_frames(frames, gif_io)
+        gif_io.seek(0)
+        return Image.open(gif_io)
+
+    def read_frames(self, image):
+        for index in range(image.n_frames):
+            image.seek(index)
+            yield image
+
+    def test_frames(self):
+        durations = [100, 200, 300, 400]
+        image = self.join([encode_gif_frame(self.create_frame(index), duration, loop=0 if index == 0 else None)
+                           for index, duration in enumerate(durations)])
+
+        self.assertEqual(image.size, (60, 40))
+        self.assertEqual(image.n_frames, 4)
+        self.assertEqual(image.info['loop'], 0)
+        self.assertEqual([frame.info['duration'] for frame in self.read_frames(image)], durations)
+
+    def test_transparency(self):
+        image = self.join([encode_gif_frame(self.create_frame(index), 100) for index in range(3)])
+
+        for frame in self.read_frames(image):
+            # Each frame is cleared before the next one, so its transparent pixels don't show the previous one
+            self.assertEqual(frame.disposal_method, 2)
+            self.assertEqual(frame.convert('RGBA').getpixel((50, 30))[3], 0)
+
+    def test_frame_sizes(self):
+        image = self.join([encode_gif_frame(self.create_frame(0, size), 100) for size in ((60, 40), (20, 80))])
+        self.assertEqual(image.size, (60, 80))
+        self.assertEqual(image.n_frames, 2)
+
+    def test_process_frames(self):
+        source = self.join([encode_gif_frame(self.create_frame(index).convert('RGB'), 100) for index in range(3)])
+        image = Image.open(BytesIO(process_frames(source, lambda frame: frame.rotate(180), workers=2)))
+
+        self.assertEqual(image.n_frames, 3)
+
+        for index, frame in enumerate(self.read_frames(image)):
+            self.assertEqual(frame.convert('RGB').getpixel((60 - 1 - index * 15 - 5, 40 - 1 - 10)), (255, 0, 0))
+
+
+class ManualExecutor(object):
+    """Runs the submitted jobs when asked to, so that the tests can look at them while they are queued."""
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        self.jobs.append((future, fn, args, kwargs))
+        return future
+
+    def run(self):
+        jobs, self.jobs = self.jobs, []
+
+        for future, fn, args, kwargs in jobs:
+            if future.set_running_or_notify_cancel():
+                future.set_result(fn(*args, **kwargs))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                   RESULT_STORE={'BACKEND': 'items.stores.MemoryResultStore'})
+class ResultJobTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.executor = ManualExecutor()
+        patcher = mock.patch('items.views.get_executor', return_value=self.executor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create_upload(self, color=(120, 60, 30)):
+        image_io = BytesIO()
+        Image.new('RGB', (64, 48), color).save(image_io, 'PNG')
+        return SimpleUploadedFile('source.png', image_io.getvalue(), 'image/png')
+
+    def submit(self, upload, text='django-watermark-images'):
+        upload.seek(0)
+        response = self.client.post(reverse('text-overlay'), {'text': text, 'image': upload})
+        self.assertEqual(response.status_code, 302)
+        return resolve(response.url).kwargs['result_id']
+
+    def get_result(self, result_id):
+        response = self.client.get(reverse('text-overlay-result', kwargs={'result_id': result_id}))
+        return response.context['result_job']['status'], response.context['source_image_src']
+
+    def assertJob(self, result_id, status, source_image_src):
+        self.assertEqual(self.get_result(result_id), (status, source_image_src))
+
+    def walk_job(self, fail):
+        upload = self.create_upload()
+        source_image_src = reverse('cached-image', kwargs={'key': _get_source_image_key(_get_upload_id(upload))})
+        create_result = views._create_text_overlay_result
+
+        def run_job(result_id, *args):
+            self.assertJob(result_id, 'running', source_image_src)
+
+            if fail:
+                raise IOError('Unable to create the result')
+
+            create_result(result_id, *args)
+
+        # The store is kept between the tests of the class, so each test submits its own text
+        with mock.patch('items.views._create_text_overlay_result', side_effect=run_job):
+            result_id = self.submit(upload, text='failed' if fail else 'done')
+            self.assertJob(result_id, 'queued', source_image_src)
+            self.executor.run()
+
+        self.assertJob(result_id, 'failed' if fail else 'done', source_image_src)
+
+    def test_same_result(self):
+        upload = self.create_upload()
+        result_id = self.submit(upload)
+
+        # Submitted again while queued, the same result doesn't get a second job
+        self.assertEqual(self.submit(upload), result_id)
+        self.assertEqual(len(self.executor.jobs), 1)
+
+        self.executor.run()
+        self.assertEqual(self.submit(upload), result_id)
+        self.assertEqual(self.get_result(result_id)[0], 'done')
+        self.assertEqual(self.executor.jobs, [])
+
+    def test_different_parameters(self):
+        upload = self.create_upload()
+        result_ids = {self.submit(upload, text='one'), self.submit(upload, text='two'),
+                      self.submit(self.create_upload(color=(30, 60, 120)), text='one')}
+
+        self.assertEqual(len(result_ids), 3)
+        self.assertEqual(len(self.executor.jobs), 3)
+
+    def test_queued_timeout(self):
+        upload = self.create_upload()
+        result_id = self.submit(upload, text='queued-timeout')
+        future = self.executor.jobs[0][0]
+
+        # Still queued after the timeout, the job is cancelled and submitted again
+        with override_settings(IMAGE_EXECUTOR_TIMEOUT=-1):
+            self.assertEqual(self.get_result(result_id)[0], 'failed')
+
+        self.assertTrue(future.cancelled())
+        self.submit(upload, text='queued-timeout')
+        self.executor.run()
+        self.assertEqual(self.get_result(result_id)[0], 'done')
+
+    def test_superseded_job(self):
+        upload = self.create_upload()
+
+        with mock.patch('items.views._create_text_overlay_result') as create_result:
+            result_id = self.submit(upload, text='superseded')
+
+            # The first job timed out in the queue of another process, which couldn't cancel it: it skips itself
+            self.executor.jobs[0][0].cancel = lambda: False
+
+            with override_settings(IMAGE_EXECUTOR_TIMEOUT=-1):
+                self.get_result(result_id)
+
+            self.submit(upload, text='superseded')
+            self.executor.run()
+
+        self.assertEqual(create_result.call_count, 1)
+        self.assertEqual(self.get_result(result_id)[0], 'done')
+
+    def test_running_timeout(self):
+        upload = self.create_upload()
+
+        def run_job(result_id, *args):
+            # A job that started is left to finish, rather than failed and submitted again
+            with override_settings(IMAGE_EXECUTOR_TIMEOUT=-1):
+                self.assertEqual(self.submit(upload, text='running-timeout'), result_id)
+                self.assertEqual(self.get_result(result_id)[0], 'running')
+
+        with mock.patch('items.views._create_text_overlay_result', side_effect=run_job):
+            result_id = self.submit(upload, text='running-timeout')
+            self.executor.run()
+
+        self.assertEqual(self.get_result(result_id)[0], 'done')
+        self.assertEqual(self.executor.jobs, [])
+
+    def test_done_job_source(self):
+        self.walk_job(fail=False)
+
+    def test_failed_job_source(self):
+        self.walk_job(fail=True)
+
+
+class RenditionsReadyTests(TestCase):
+    def setUp(self):
+        self.item = Item.objects.create(title='Item', image='original_image/item.png')
+        Item.objects.filter(pk=self.item.pk).update(renditions_status=Item.RENDITIONS_DONE,
+                                                    renditions_fingerprint=get_renditions_fingerprint())
+        self.item.refresh_from_db()
+
+    def test_current(self):
+        self.assertTrue(self.item.renditions_ready)
+
+        with mock.patch('items.views.schedule_renditions') as schedule_renditions:
+            views.ItemDetail(kwargs={'pk': self.item.pk}).get_object()
+
+        schedule_renditions.assert_not_called()
+
+    def test_outdated(self):
+        Item.objects.filter(pk=self.item.pk).update(renditions_fingerprint='outdated')
+        self.item.refresh_from_db()
+        self.assertFalse(self.item.renditions_ready)
+
+        # The page schedules the rebuild and shows the renditions as pending, rather than generating them
+        response = self.client.get(self.item.get_absolute_url())
+        self.assertEqual(response.context['object'].renditions_status, Item.RENDITIONS_QUEUED)
+        self.assertContains(response, 'The renditions are being generated')
+
+
+def _starts_sweeper():
+    with mock.patch('items.stores.threading.Thread') as thread:
+        _create_result_store()
+
+    return thread.called
+
+
+@override_settings(RESULT_STORE={'BACKEND': 'items.stores.MemoryResultStore', 'TTL': 60, 'SWEEP_INTERVAL': 60})
+class SweeperTests(SimpleTestCase):
+    def test_pool_workers(self):
+        self.assertTrue(_starts_sweeper())
+
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            self.assertFalse(executor.submit(_starts_sweeper).result())
+
+
+class SourceTTLTests(SimpleTestCase):
+    ttl = 60
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.location)
+        settings_override = override_settings(RESULT_STORE={'BACKEND': 'items.stores.FileSystemResultStore',
+                                                            'TTL': self.ttl, 'OPTIONS': {'location': self.location}})
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def age(self, seconds):
+        for directory, directory_names, file_names in os.walk(self.location):
+            for file_name in file_names:
+                path = os.path.join(directory, file_name)
+                os.utime(path, (os.path.getmtime(path) - seconds,) * 2)
+
+    def test_reused_source(self):
+        upload = SimpleUploadedFile('source.png', b'source image', 'image/png')
+        key = _get_source_image_key('source')
+        _save_source_upload(upload, 'source')
+
+        # Uploaded again (for another result) shortly before it expires, the source is kept for another TTL
+        self.age(self.ttl - 1)
+        _save_source_upload(upload, 'source')
+        self.age(2)
+        self.assertEqual(get_result_store().sweep(), 0)
+        self.assertIsNotNone(get_result_store().get_meta(key))
+
+        self.age(self.ttl)
+        self.assertEqual(get_result_store().sweep(), 2)
+        self.assertIsNone(get_result_store().get_meta(key))
+
+
+@override_settings(METRICS_ENABLED=True)
+class EncodingStatsTests(SimpleTestCase):
+    def get_count(self):
+        return get_encoding_stats().get('steganography:png', {}).get('count', 0)
+
+    def test_encoding_stats(self):
+        # The stats come from the histograms of the process, which other tests add to
+        count = self.get_count()
+        image_bytes, content_type = encode_image(Image.new('RGB', (64, 64)), 'steganography')
+
+        self.assertEqual(self.get_count(), count + 1)
+        self.assertGreaterEqual(get_encoding_stats()['steganography:png']['average_bytes'], 1)
+
+
+# Small enough that the test images are composited strip by strip, a few rows at a time
+@override_settings(TILED_PROCESSING_MIN_PIXELS=1000, TILED_PROCESSING_MAX_BYTES=12 * 480 * 10)
+class CompositingTests(SimpleTestCase):
+    def create_image(self, mode):
+        pixels = np.random.RandomState(0).randint(0, 256, (320, 480, len(mode)), dtype=np.uint8)
+        return Image.fromarray(pixels, mode)
+
+    def composite(self, image, overlay):
+        """Composites a full frame overlay with Pillow, the way the patches and strips are expected to."""
+        return Image.alpha_composite(image.convert('RGBA'), overlay).convert(image.mode)
+
+    def assertImagesEqual(self, image, expected_image):
+        self.assertEqual((image.mode, image.size), (expected_image.mode, expected_image.size))
+        # Over RGB images the patch is pasted through its alpha, which rounds like alpha_composite up to one level
+        difference = np.abs(np.asarray(image, dtype=np.int16) - np.asarray(expected_image, dtype=np.int16))
+        self.assertLessEqual(difference.max(), 1)
+
+    def test_text_overlay(self):
+        font = get_font()
+        text = 'django-watermark-images'
+
+        for mode in ('RGB', 'RGBA'):
+            image = self.create_image(mode)
+            overlay = Image.new('RGBA', image.size, (255, 255, 255, 0))
+            image_draw = ImageDraw.Draw(overlay)
+            text_size_x, text_size_y = image_draw.textsize(text, font=font)
+            image_draw.text((image.size[0] / 2 - text_size_x / 2, image.size[1] / 2 - text_size_y / 2), text,
+                            font=font, fill=(255, 255, 255, 128))
+
+            self.assertImagesEqual(add_text_overlay(image, text, font=font), self.composite(image, overlay))
+
+    def test_watermark(self):
+        watermark = Image.new('RGB', (120, 60), (250, 200, 100))
+        watermark.paste((20, 40, 240), (20, 10, 100, 50))
+
+        for mode in ('RGB', 'RGBA'):
+            image = self.create_image(mode)
+            # Scaled to cover half of the image along its longer side, and centered
+            patch, mask = prepare_watermark(watermark, (320, 160))
+            overlay = Image.new('RGBA', image.size, (255, 255, 255, 0))
+            overlay.paste(patch, (80, 80))
+
+            self.assertImagesEqual(add_watermark(image, watermark), self.composite(image, overlay))
@@ -1,22 +1,58 @@
-import uuid
-
-from functools import lru_cache
+import hashlib
+import logging
+import re
+import threading
+import time
+
+from concurrent.futures import TimeoutError
+from contextlib import contextmanager
+from functools import lru_cache, partial
 from io import BytesIO
 
 from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
 from django.core.cache import cache
-from django.http import HttpResponseRedirect, HttpResponse
+from django.http import (Http404, HttpResponseRedirect, HttpResponse, FileResponse, JsonResponse,
+                         StreamingHttpResponse)
 from django.urls import reverse_lazy
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 from django.views.generic import TemplateView, FormView, View
 from django.views.generic.detail import DetailView
 from django.views.generic.edit import CreateView
 
-from magic import Magic
 from PIL import Image, ImageFont
 
-from .forms import TextOverlayForm, WatermarkForm, SteganographyForm, ItemForm
+from .encoding import encode_image, get_encoding_profile_key, get_encoding_stats, has_webp_variant
+from .executors import ExecutorBusy, get_executor, is_inline
+from .frames import is_multi_frame, process_frames
+from .forms import TextOverlayForm, WatermarkForm, SteganographyForm, ScanForm, ItemForm
+from .metrics import collect, export_prometheus, get_stage_totals, observe, record, span
 from .models import Item
-from .processors import add_text_overlay, add_watermark, lsb_encode, lsb_decode
+from .payloads import find_items, get_payload_text
+from .processors import (add_text_overlay, add_tiled_watermark, add_watermark, get_fit_size, get_font_key,
+                         hidden_watermark_decode, hidden_watermark_encode, open_image, scan_image)
+from .renditions import regenerate_renditions, schedule_renditions
+from .stores import get_result_store
+
+
+logger = logging.getLogger(__name__)
+
+_range_re = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+_stream_chunk_size = 64 * 1024
+
+_job_queued = 'queued'
+_job_running = 'running'
+_job_done = 'done'
+_job_failed = 'failed'
+
+_job_futures = {}
+_job_futures_lock = threading.Lock()
+
+_renditions_batch_key = 'renditions-batch'
+_renditions_batch_lock = threading.Lock()
 
 
 @lru_cache(maxsize=1)
@@ -25,48 +61,302 @@ def _get_placeholder_image_bytes():
         return fp.read()
 
 
-def _create_result_id():
-    return uuid.uuid4().hex
+def _get_upload_id(upload):
+    upload_hash = hashlib.sha256()
+
+    with span('upload-hash', bytes=upload.size):
+        for chunk in upload.chunks():
+            upload_hash.update(chunk)
+
+    upload.seek(0)
+    return upload_hash.hexdigest()
+
+
+def _create_result_id(*parts):
+    result_hash = hashlib.sha256()
+
+    for part in parts:
+        result_hash.update(str(part).encode('utf-8'))
+        result_hash.update(b'\0')
+
+    return result_hash.hexdigest()[:32]
 
 
 def _get_cache_key(prefix, result_id):
     return '{prefix}-image-{result_id}'.format(prefix=prefix, result_id=result_id)
 
 
-def _get_source_image_key(result_id):
-    return _get_cache_key('source', result_id)
+def _get_source_image_key(source_id):
+    return _get_cache_key('source', source_id)
 
 
 def _get_result_image_key(result_id):
     return _get_cache_key('result', result_id)
 
 
-def _save_image(key, image, format_='png'):
-    bytes_io = BytesIO()
-    image.save(bytes_io, format=format_)
-    cache.set(key, bytes_io.getvalue())
+def _get_webp_image_key(key):
+    return '{key}-webp'.format(key=key)
+
+
+def _get_result_source_id_key(result_id):
+    return 'result-source-{result_id}'.format(result_id=result_id)
+
+
+def _get_result_timeout():
+    # The links and the jobs of the results are kept as long as their images
+    return settings.RESULT_STORE.get('TTL')
+
+
+def _get_result_source_image_key(result_id):
+    return _get_source_image_key(cache.get(_get_result_source_id_key(result_id), result_id))
+
+
+def _save_image_bytes(key, image_bytes, content_type):
+    with span('store-write', bytes=len(image_bytes)):
+        get_result_store().save(key, image_bytes, content_type)
+
+
+def _save_source_upload(upload, source_id):
+    key = _get_source_image_key(source_id)
+
+    # A source that is uploaded again is kept as long as the new results that depend on it
+    if not get_result_store().touch(key):
+        upload.seek(0)
+
+        with span('store-write', bytes=upload.size):
+            get_result_store().save_file(key, upload, upload.content_type)
+
+
+def _get_job_image(upload):
+    # Only inline jobs run before the upload is closed, the others open the stored copy of it
+    return upload.image if is_inline() else None
+
+
+def _save_result_image(image, result_id, encoding_profile, lossless=False):
+    key = _get_result_image_key(result_id)
+    _save_image_bytes(key, *encode_image(image, encoding_profile, lossless=lossless))
+
+    if has_webp_variant(encoding_profile):
+        _save_image_bytes(_get_webp_image_key(key), *encode_image(image, encoding_profile, lossless=lossless,
+                                                                  webp=True))
+
+
+def _save_result_frames(image_bytes, result_id):
+    _save_image_bytes(_get_result_image_key(result_id), image_bytes, 'image/gif')
+
+
+def _get_job_key(result_id):
+    return 'result-job-{result_id}'.format(result_id=result_id)
+
+
+def _cancel_job(result_id):
+    # Only the futures of the jobs submitted by this process are known, the others skip themselves (see _run_job)
+    with _job_futures_lock:
+        future = _job_futures.get(result_id)
+
+    if future is not None:
+        future.cancel()
+
+
+def _get_job(result_id):
+    job = cache.get(_get_job_key(result_id))
+
+    # A job still queued after the timeout is cancelled and reported as failed, so that the next request submits it
+    # again. A job that started is left to finish, rather than being run twice.
+    if (job is not None and job['status'] == _job_queued and
+            job['queued'] < time.time() - settings.IMAGE_EXECUTOR_TIMEOUT):
+        _cancel_job(result_id)
+        job.update(status=_job_failed, finished=time.time(), error='Timed out')
+        cache.set(_get_job_key(result_id), job, timeout=_get_result_timeout())
+
+    return job
+
+
+def _update_job(result_id, **kwargs):
+    job = _get_job(result_id) or {}
+    job.update(kwargs)
+    cache.set(_get_job_key(result_id), job, timeout=_get_result_timeout())
+    return job
+
+
+def _run_job(fn, result_id, queued, *args):
+    # The timings are returned to the submitting process, since jobs may run in a process pool
+    with collect() as entries:
+        job = _get_job(result_id)
+
+        # The job timed out while queued (and may have been submitted again), or its result expired
+        if job is None or job['status'] != _job_queued or job['queued'] != queued:
+            return entries
+
+        job = _update_job(result_id, status=_job_running, started=time.time())
+        observe('queue', job['started'] - job['queued'])
+
+        try:
+            fn(result_id, *args)
+        except Exception as e:
+            logger.exception('Unable to create result %s', result_id)
+            _update_job(result_id, status=_job_failed, finished=time.time(), error=str(e))
+        else:
+            _update_job(result_id, status=_job_done, finished=time.time())
+
+    return entries
+
+
+def _finish_job(result_id, future):
+    with _job_futures_lock:
+        if _job_futures.get(result_id) is future:
+            del _job_futures[result_id]
+
+    if future.cancelled():
+        return
+
+    if future.exception() is not None:
+        # The job couldn't record its failure itself (its worker process died)
+        _update_job(result_id, status=_job_failed, finished=time.time(), error=str(future.exception()))
+        return
+
+    record(future.result())
+
+
+def _submit_job(fn, result_id, source_id, *args):
+    # The result is linked to its source up front, so the pages of queued, running and failed jobs show it too
+    cache.set(_get_result_source_id_key(result_id), source_id, timeout=_get_result_timeout())
+    job = _update_job(result_id, status=_job_queued, queued=time.time(), started=None, finished=None, error=None)
+
+    try:
+        future = get_executor().submit(_run_job, fn, result_id, job['queued'], source_id, *args)
+    except ExecutorBusy:
+        cache.delete(_get_job_key(result_id))
+        raise
+
+    with _job_futures_lock:
+        if not future.done():
+            _job_futures[result_id] = future
+
+    future.add_done_callback(partial(_finish_job, result_id))
+
+
+def _get_job_status(result_id):
+    job = _get_job(result_id)
+
+    # Finished jobs are checked against the result store, since their images expire
+    if job is not None and job['status'] != _job_done:
+        return job['status']
+
+    if _get_image_meta(_get_result_image_key(result_id)) is not None:
+        return _job_done
+
+    return None
+
+
+def _result_exists(result_id):
+    # The lookups are timed as hits or misses, which /result-stats/ counts
+    with span('result-lookup') as lookup_span:
+        exists = _get_job_status(result_id) not in (None, _job_failed)
+        lookup_span.stage = 'result-hit' if exists else 'result-miss'
+
+    return exists
+
+
+def _get_image_meta(key):
+    return get_result_store().get_meta(key)
+
+
+@contextmanager
+def _open_source(source_id, image=None):
+    """Yields the source image opened, but not decoded yet."""
+    if image is not None:
+        yield image
+        return
+
+    image_fp = get_result_store().open(_get_source_image_key(source_id))
+
+    if image_fp is None:
+        raise IOError('The source image {source_id} has expired'.format(source_id=source_id))
+
+    with image_fp:
+        yield Image.open(image_fp)
+
+
+def _open_source_image(source_id, image=None, max_size=None):
+    with _open_source(source_id, image) as image:
+        return open_image(image, max_size=max_size, max_pixels=settings.IMAGE_MAX_PIXELS)
+
+
+def _fit_frame(frame):
+    frame_size = get_fit_size(frame.size, settings.IMAGE_MAX_WORKING_SIZE)
+    return frame.resize(frame_size, resample=Image.ANTIALIAS) if frame_size != frame.size else frame
+
 
+def _create_overlay_result(result_id, source_id, source_image, encoding_profile, add_overlay):
+    # Animated (and multi-page) sources are processed frame by frame, and the result is an animated GIF
+    with _open_source(source_id, source_image) as image:
+        if is_multi_frame(image):
+            _save_result_frames(process_frames(image, lambda frame: add_overlay(_fit_frame(frame))), result_id)
+            return
 
-def _save_source_image(image, result_id, format_=None):
-    _save_image(_get_source_image_key(result_id), image, format_=format_ if format_ is not None else image.format)
+        image = open_image(image, max_size=settings.IMAGE_MAX_WORKING_SIZE, max_pixels=settings.IMAGE_MAX_PIXELS)
 
+    _save_result_image(add_overlay(image), result_id, encoding_profile)
 
-def _save_result_image(image, result_id, format_='png'):
-    _save_image(_get_result_image_key(result_id), image, format_=format_)
+
+def _create_text_overlay_result(result_id, source_id, text, source_image=None):
+    def add_overlay(image):
+        with span('text-overlay', size=image.size):
+            return add_text_overlay(image, text)
+
+    _create_overlay_result(result_id, source_id, source_image, 'text-overlay', add_overlay)
+
+
+def _create_watermark_result(result_id, source_id, watermark_id, layout='center', source_image=None,
+                             watermark_image=None):
+    watermark_image = _open_source_image(watermark_id, watermark_image)
+
+    def add_overlay(image):
+        with span('watermark', size=image.size):
+            if layout == 'tiled':
+                return add_tiled_watermark(image, watermark_image, watermark_key=watermark_id,
+                                           **settings.WATERMARK_TILE)
+
+            return add_watermark(image, watermark_image, watermark_key=watermark_id)
+
+    _create_overlay_result(result_id, source_id, source_image, 'watermark', add_overlay)
+
+
+def _get_steganography_profile(engine):
+    return 'steganography' if engine == 'lsb' else 'robust-steganography'
+
+
+def _create_steganography_result(result_id, source_id, text, engine='lsb', source_image=None):
+    image = _open_source_image(source_id, source_image, max_size=settings.IMAGE_MAX_WORKING_SIZE)
+
+    with span('steganography', size=image.size):
+        result_image = hidden_watermark_encode(text, image, engine=engine)
+
+    _save_result_image(result_image, result_id, _get_steganography_profile(engine), lossless=engine == 'lsb')
+
+
+def _get_busy_response():
+    response = HttpResponse('The server is busy, please try again later.', content_type='text/plain', status=503)
+    response['Retry-After'] = settings.IMAGE_EXECUTOR_RETRY_AFTER
+    return response
 
 
 def _get_image_fp(key):
-    image_bytes = cache.get(key)
+    image_fp = get_result_store().open(key)
 
-    if image_bytes is None:
-        image_bytes = _get_placeholder_image_bytes()
+    if image_fp is None:
+        image_fp = BytesIO(_get_placeholder_image_bytes())
 
-    image_fp = BytesIO(image_bytes)
     return image_fp
 
 
 def _get_image(key):
-    return Image.open(_get_image_fp(key))
+    with _get_image_fp(key) as image_fp:
+        image = Image.open(image_fp)
+        image.load()
+
+    return image
 
 
 class TextOverlay(FormView):
@@ -75,13 +365,18 @@ class TextOverlay(FormView):
 
     def form_valid(self, form):
         text = form.cleaned_data['text']
-        image = Image.open(form.cleaned_data['image'])
+        image_file = form.cleaned_data['image']
+        source_id = _get_upload_id(image_file)
+        result_id = _create_result_id(source_id, 'text-overlay', text, get_font_key(),
+                                      get_encoding_profile_key('text-overlay'))
 
-        result_image = add_text_overlay(image, text)
+        if not _result_exists(result_id):
+            _save_source_upload(image_file, source_id)
 
-        result_id = _create_result_id()
-        _save_source_image(image, result_id)
-        _save_result_image(result_image, result_id)
+            try:
+                _submit_job(_create_text_overlay_result, result_id, source_id, text, _get_job_image(image_file))
+            except ExecutorBusy:
+                return _get_busy_response()
 
         return HttpResponseRedirect(reverse_lazy('text-overlay-result', kwargs={'result_id': result_id}))
 text_overlay = TextOverlay.as_view()
@@ -94,9 +389,11 @@ class TextOverlayResult(TemplateView):
         context_data = super().get_context_data(**kwargs)
         result_id = kwargs.get('result_id', 'unknown')
         context_data['source_image_src'] = reverse_lazy('cached-image',
-                                                        kwargs={'key': _get_source_image_key(result_id)})
+                                                        kwargs={'key': _get_result_source_image_key(result_id)})
         context_data['result_image_src'] = reverse_lazy('cached-image',
                                                         kwargs={'key': _get_result_image_key(result_id)})
+        context_data['result_status_src'] = reverse_lazy('result-status', kwargs={'result_id': result_id})
+        context_data['result_job'] = _get_job(result_id) or {'status': _get_job_status(result_id)}
         return context_data
 text_overlay_result = TextOverlayResult.as_view()
 
@@ -107,14 +404,28 @@ class Watermark(FormView):
 
 
     def form_valid(self, form):
-        image = Image.open(form.cleaned_data['image'])
-        watermark_image = Image.open(form.cleaned_data['watermark_image'])
-
-        result_image = add_watermark(image, watermark_image)
-
-        result_id = _create_result_id()
-        _save_source_image(image, result_id)
-        _save_result_image(result_image, result_id)
+        layout = form.cleaned_data['layout']
+        image_file = form.cleaned_data['image']
+        watermark_image_file = form.cleaned_data['watermark_image']
+        source_id = _get_upload_id(image_file)
+        watermark_id = _get_upload_id(watermark_image_file)
+
+        if layout == 'tiled':
+            result_id = _create_result_id(source_id, 'watermark', watermark_id, layout,
+                                          sorted(settings.WATERMARK_TILE.items()),
+                                          get_encoding_profile_key('watermark'))
+        else:
+            result_id = _create_result_id(source_id, 'watermark', watermark_id, get_encoding_profile_key('watermark'))
+
+        if not _result_exists(result_id):
+            _save_source_upload(image_file, source_id)
+            _save_source_upload(watermark_image_file, watermark_id)
+
+            try:
+                _submit_job(_create_watermark_result, result_id, source_id, watermark_id, layout,
+                            _get_job_image(image_file), _get_job_image(watermark_image_file))
+            except ExecutorBusy:
+                return _get_busy_response()
 
         return HttpResponseRedirect(reverse_lazy('watermark-result', kwargs={'result_id': result_id}))
 watermark = Watermark.as_view()
@@ -127,9 +438,11 @@ class WatermarkResult(TemplateView):
         context_data = super().get_context_data(**kwargs)
         result_id = kwargs.get('result_id', 'unknown')
         context_data['source_image_src'] = reverse_lazy('cached-image',
-                                                        kwargs={'key': _get_source_image_key(result_id)})
+                                                        kwargs={'key': _get_result_source_image_key(result_id)})
         context_data['result_image_src'] = reverse_lazy('cached-image',
                                                         kwargs={'key': _get_result_image_key(result_id)})
+        context_data['result_status_src'] = reverse_lazy('result-status', kwargs={'result_id': result_id})
+        context_data['result_job'] = _get_job(result_id) or {'status': _get_job_status(result_id)}
         return context_data
 watermark_result = WatermarkResult.as_view()
 
@@ -140,13 +453,20 @@ class Steganography(FormView):
 
     def form_valid(self, form):
         text = form.cleaned_data['text']
-        image = Image.open(form.cleaned_data['image'])
+        engine = form.cleaned_data['engine']
+        image_file = form.cleaned_data['image']
+        source_id = _get_upload_id(image_file)
+        result_id = _create_result_id(source_id, 'steganography', text, engine,
+                                      get_encoding_profile_key(_get_steganography_profile(engine)))
 
-        result_image = lsb_encode(text, image)
+        if not _result_exists(result_id):
+            _save_source_upload(image_file, source_id)
 
-        result_id = _create_result_id()
-        _save_source_image(image, result_id)
-        _save_result_image(result_image, result_id)
+            try:
+                _submit_job(_create_steganography_result, result_id, source_id, text, engine,
+                            _get_job_image(image_file))
+            except ExecutorBusy:
+                return _get_busy_response()
 
         return HttpResponseRedirect(reverse_lazy('steganography-result', kwargs={'result_id': result_id}))
 steganography = Steganography.as_view()
@@ -159,31 +479,265 @@ class SteganographyResult(TemplateView):
         context_data = super().get_context_data(**kwargs)
         result_id = kwargs.get('result_id', 'unknown')
         context_data['source_image_src'] = reverse_lazy('cached-image',
-                                                        kwargs={'key': _get_source_image_key(result_id)})
+                                                        kwargs={'key': _get_result_source_image_key(result_id)})
         context_data['result_image_src'] = reverse_lazy('cached-image',
                                                         kwargs={'key': _get_result_image_key(result_id)})
+        context_data['result_status_src'] = reverse_lazy('result-status', kwargs={'result_id': result_id})
+        context_data['result_job'] = _get_job(result_id) or {'status': _get_job_status(result_id)}
 
-        result_image = _get_image(_get_result_image_key(result_id))
-        text = lsb_decode(result_image)
-        context_data['text'] = text
+        if context_data['result_job']['status'] == _job_done:
+            result_image = _get_image(_get_result_image_key(result_id))
+            text = hidden_watermark_decode(result_image)
+            context_data['text'] = text.hex() if isinstance(text, bytes) else text
 
         return context_data
 
 steganography_result = SteganographyResult.as_view()
 
 
+def _scan_upload(image_bytes):
+    # The timings are returned along with the result, as for the jobs
+    with collect() as entries:
+        with span('scan', bytes=len(image_bytes)):
+            result = scan_image(BytesIO(image_bytes))
+
+    return result, entries
+
+
+class Scan(FormView):
+    template_name = 'items/scan.html'
+    form_class = ScanForm
+
+    def form_valid(self, form):
+        image_file = form.cleaned_data['image']
+        image_file.seek(0)
+
+        # Decoding a DCT payload decodes the whole image, so the scan runs on the executor like the other operations
+        try:
+            result, entries = get_executor().submit(_scan_upload, image_file.read()).result(
+                timeout=settings.IMAGE_EXECUTOR_TIMEOUT
+            )
+        except (ExecutorBusy, TimeoutError):
+            return _get_busy_response()
+
+        record(entries)
+
+        context_data = self.get_context_data(form=form, scanned=True)
+
+        if result is not None:
+            engine, payload = result
+            context_data.update(engine=engine, payload=get_payload_text(payload), items=find_items(payload))
+
+        return self.render_to_response(context_data)
+scan = Scan.as_view()
+
+
+def _get_negotiated_image_key(request, key):
+    if 'image/webp' in request.META.get('HTTP_ACCEPT', ''):
+        webp_key = _get_webp_image_key(key)
+
+        if _get_image_meta(webp_key) is not None:
+            return webp_key
+
+    return key
+
+
+def _get_image_etag(request, key=None, **kwargs):
+    image_meta = _get_image_meta(_get_negotiated_image_key(request, key))
+    return image_meta['etag'] if image_meta is not None else None
+
+
+def _get_image_last_modified(request, key=None, **kwargs):
+    image_meta = _get_image_meta(_get_negotiated_image_key(request, key))
+    return image_meta['last_modified'] if image_meta is not None else None
+
+
+def _parse_range(range_header, size):
+    match = _range_re.match(range_header.strip())
+
+    if match is None:
+        return None
+
+    start, end = match.groups()
+
+    if not start and not end:
+        return None
+
+    if not start:
+        return max(size - int(end), 0), size
+
+    if end and int(end) < int(start):
+        # Syntactically invalid, the header is ignored
+        return None
+
+    return int(start), min(int(end) + 1, size) if end else size
+
+
+def _get_accel_redirect_response(key, image_meta):
+    relative_path = get_result_store().get_relative_path(key)
+
+    if settings.RESULT_STORE_ACCEL_REDIRECT_URL is None or relative_path is None:
+        return None
+
+    # nginx sends the file (and answers range requests) without holding the worker
+    response = HttpResponse(content_type=image_meta['content_type'])
+    response['X-Accel-Redirect'] = '{url}{path}'.format(url=settings.RESULT_STORE_ACCEL_REDIRECT_URL,
+                                                        path=relative_path)
+    return response
+
+
+def _iter_image_bytes(image_fp, start, stop):
+    try:
+        image_fp.seek(start)
+
+        for offset in range(start, stop, _stream_chunk_size):
+            yield image_fp.read(min(_stream_chunk_size, stop - offset))
+    finally:
+        image_fp.close()
+
+
+@method_decorator(condition(etag_func=_get_image_etag, last_modified_func=_get_image_last_modified), name='get')
 class CachedImage(View):
     def get(self, request, key=None, **kwargs):
-        image_fp = _get_image_fp(key)
-        magic = Magic(mime=True)
-        content_type = magic.from_buffer(image_fp.read(1024))
-        image_fp.seek(0)
-        return HttpResponse(image_fp, content_type=content_type)
+        key = _get_negotiated_image_key(request, key)
+        image_meta = _get_image_meta(key)
+        response = _get_accel_redirect_response(key, image_meta) if image_meta is not None else None
+
+        if response is not None:
+            return self._patch_response(response)
+
+        image_fp = get_result_store().open(key) if image_meta is not None else None
+
+        if image_fp is None:
+            response = HttpResponse(_get_placeholder_image_bytes(), content_type='image/png')
+            patch_cache_control(response, no_cache=True)
+            return response
+
+        size = image_meta['size']
+        start, stop = 0, size
+        byte_range = _parse_range(request.META['HTTP_RANGE'], size) if 'HTTP_RANGE' in request.META else None
+
+        if byte_range is not None and byte_range[0] >= size:
+            image_fp.close()
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */{size}'.format(size=size)
+            return response
+
+        if byte_range is not None:
+            start, stop = byte_range
+            response = StreamingHttpResponse(_iter_image_bytes(image_fp, start, stop),
+                                             content_type=image_meta['content_type'], status=206)
+            response['Content-Range'] = 'bytes {start}-{end}/{size}'.format(start=start, end=stop - 1, size=size)
+        else:
+            # Served with the server's wsgi.file_wrapper (sendfile) when the store returns real files
+            response = FileResponse(image_fp, content_type=image_meta['content_type'])
+
+        response['Content-Length'] = stop - start
+        response['Accept-Ranges'] = 'bytes'
+        return self._patch_response(response)
+
+    def _patch_response(self, response):
+        patch_vary_headers(response, ('Accept',))
+        patch_cache_control(response, public=True, max_age=365 * 24 * 60 * 60, immutable=True)
+        return response
 cached_image = CachedImage.as_view()
 
 
+class ResultStatus(View):
+    def get(self, request, result_id=None, **kwargs):
+        job = _get_job(result_id)
+
+        if job is None:
+            if _get_job_status(result_id) is None:
+                raise Http404('Unknown result {result_id}'.format(result_id=result_id))
+
+            job = {'status': _job_done}
+
+        job_status = {'status': job['status'], 'error': job.get('error')}
+
+        if job.get('started') is not None:
+            job_status['queue_time'] = job['started'] - job['queued']
+
+            if job.get('finished') is not None:
+                job_status['run_time'] = job['finished'] - job['started']
+
+        return JsonResponse(job_status)
+result_status = ResultStatus.as_view()
+
+
+class ResultStats(View):
+    """Reports the results that were reused and the encoding of the new ones, from the metrics of the current process
+    (the jobs that ran in a process pool included)."""
+
+    def get(self, request, **kwargs):
+        if not settings.METRICS_ENABLED:
+            raise Http404('Metrics are disabled')
+
+        stage_totals = get_stage_totals()
+        result_stats = {name: stage_totals.get(stage, {}).get('count', 0)
+                        for name, stage in (('hits', 'result-hit'), ('misses', 'result-miss'))}
+        result_stats['encoding'] = get_encoding_stats()
+        return JsonResponse(result_stats)
+result_stats = ResultStats.as_view()
+
+
+class Metrics(View):
+    """Exports the histograms of the process that answers the request, which only count the requests it served and
+    the jobs it submitted. Behind a server with several worker processes (like gunicorn), each scrape sees one of them:
+    run a single worker process, or scrape each one separately."""
+
+    def get(self, request, **kwargs):
+        if not settings.METRICS_ENABLED:
+            raise Http404('Metrics are disabled')
+
+        return HttpResponse(export_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+metrics = Metrics.as_view()
+
+
+def _run_renditions_batch(force):
+    try:
+        cache.set(_renditions_batch_key, {'status': 'running'}, timeout=None)
+        stats = regenerate_renditions(
+            workers=settings.RENDITIONS_BATCH_WORKERS, force=force,
+            checkpoint_path=settings.RENDITIONS_BATCH_CHECKPOINT,
+            progress=lambda stats: cache.set(_renditions_batch_key, dict(stats, status='running'), timeout=None)
+        )
+        cache.set(_renditions_batch_key, dict(stats, status='done'), timeout=None)
+    except Exception as e:
+        logger.exception('Unable to regenerate the renditions')
+        cache.set(_renditions_batch_key, {'status': 'failed', 'error': str(e)}, timeout=None)
+    finally:
+        _renditions_batch_lock.release()
+
+
+@method_decorator(staff_member_required, name='dispatch')
+class RenditionsBatch(View):
+    def get(self, request, **kwargs):
+        return JsonResponse(cache.get(_renditions_batch_key) or {'status': 'idle'})
+
+    def post(self, request, **kwargs):
+        if not _renditions_batch_lock.acquire(blocking=False):
+            return JsonResponse({'status': 'running'}, status=409)
+
+        thread = threading.Thread(target=_run_renditions_batch, args=(request.POST.get('force') == '1',))
+        thread.daemon = True
+        thread.start()
+
+        return JsonResponse({'status': 'started'}, status=202)
+renditions_batch = RenditionsBatch.as_view()
+
+
 class ItemDetail(DetailView):
     model = Item
+
+    def get_object(self, queryset=None):
+        item = super().get_object(queryset)
+
+        if item.renditions_status == Item.RENDITIONS_DONE and not item.renditions_ready:
+            schedule_renditions(item)
+            item.refresh_from_db(fields=('renditions_status', 'renditions_generated', 'renditions_total'))
+
+        return item
 item_detail = ItemDetail.as_view()
 
 